@@ -0,0 +1,146 @@
+#!/nfs_share/matt_desktop/server_scripts/ip_profile/venv_311/bin/python3.11
+import csv
+from array import array
+from bisect import bisect_right
+from ipaddress import ip_address, ip_network
+
+# Fields returned for each ip, in the same shape as the ipinfo.io api
+geo_fields: tuple[str, ...] = ('city', 'region', 'country', 'loc', 'org', 'postal', 'timezone')
+
+
+class GeoIpIndex:
+    """An offline alternative to the ipinfo.io api, built from a local ip-range database.
+
+    Each range is stored as integer (start, end) bounds in sorted arrays, and lookups are a binary search over the
+    starts. IPv4 bounds fit in a compact array. IPv6 bounds are too big for an array, so they are kept in plain lists.
+    Locations are shared between ranges, so each range only stores an index into self.records.
+
+    Load a csv with a header row of start, end, country, region, city, org, loc, and optionally postal and timezone.
+    start and end can be ip addresses or integers. A network column in CIDR notation can be used instead of start and
+    end. MaxMind .mmdb files are also supported when the maxminddb package is installed."""
+
+    def __init__(self):
+        self.starts: dict[int, array | list[int]] = {4: array('L'), 6: []}
+        self.ends: dict[int, array | list[int]] = {4: array('L'), 6: []}
+        self.record_ids: dict[int, array] = {4: array('L'), 6: array('L')}
+        self.records: list[tuple[str | None, ...]] = []
+        self.record_lookup: dict[tuple, int] = {}  # Used while loading to share identical records between ranges
+
+    def __len__(self) -> int:
+        return len(self.starts[4]) + len(self.starts[6])
+
+    @classmethod
+    def load(cls, path: str) -> 'GeoIpIndex':
+        if path.endswith('.mmdb'):
+            return cls.from_mmdb(path)
+        else:
+            return cls.from_csv(path)
+
+    @classmethod
+    def from_csv(cls, path: str) -> 'GeoIpIndex':
+        index: GeoIpIndex = cls()
+        ranges: list[tuple[int, int, int, int]] = []
+
+        with open(path, 'r', newline='') as fh:
+            for row in csv.DictReader(fh):
+                if row.get('network'):
+                    network = ip_network(row['network'], strict=False)
+                    version: int = network.version
+                    start: int = int(network.network_address)
+                    end: int = int(network.broadcast_address)
+                else:
+                    first, last = ip_address(to_ip(row['start'])), ip_address(to_ip(row['end']))
+                    version: int = first.version
+                    start, end = int(first), int(last)
+
+                record: tuple[str | None, ...] = tuple(row.get(field) or None for field in geo_fields)
+                ranges.append((version, start, end, index.add_record(record)))
+
+        index.build(ranges)
+        return index
+
+    @classmethod
+    def from_mmdb(cls, path: str) -> 'GeoIpIndex':
+        try:
+            import maxminddb
+        except ImportError:
+            raise ImportError('Reading .mmdb files requires the maxminddb package (pip install maxminddb)')
+
+        index: GeoIpIndex = cls()
+        ranges: list[tuple[int, int, int, int]] = []
+
+        with maxminddb.open_database(path) as reader:
+            for network, data in reader:
+                record: tuple[str | None, ...] = mmdb_record(data)
+                ranges.append((
+                    network.version,
+                    int(network.network_address),
+                    int(network.broadcast_address),
+                    index.add_record(record)
+                ))
+
+        index.build(ranges)
+        return index
+
+    def add_record(self, record: tuple[str | None, ...]) -> int:
+        if record not in self.record_lookup:
+            self.record_lookup[record] = len(self.records)
+            self.records.append(record)
+
+        return self.record_lookup[record]
+
+    def build(self, ranges: list[tuple[int, int, int, int]]) -> None:
+        for version, start, end, record_id in sorted(ranges):
+            self.starts[version].append(start)
+            self.ends[version].append(end)
+            self.record_ids[version].append(record_id)
+
+        self.record_lookup.clear()
+
+    def lookup(self, ip_addr: str) -> dict[str, str] | None:
+        # Returns the same dict shape as ip_info(), or None if the ip is not covered by the database
+        try:
+            address = ip_address(ip_addr)
+        except ValueError:
+            return None
+
+        version: int = address.version
+        value: int = int(address)
+        position: int = bisect_right(self.starts[version], value) - 1
+
+        if position < 0 or value > self.ends[version][position]:
+            if address.is_private or address.is_loopback or address.is_reserved:
+                return {'ip': ip_addr, 'bogon': True}  # Same as the api does for addresses that are not routable
+            return None
+
+        record: tuple[str | None, ...] = self.records[self.record_ids[version][position]]
+        data: dict[str, str] = {'ip': ip_addr}
+        data.update({field: val for field, val in zip(geo_fields, record) if val is not None})
+        return data
+
+
+def to_ip(value: str) -> str | int:
+    # Range bounds may be written as addresses or as integers
+    value = value.strip()
+    return int(value) if value.isdigit() else value
+
+
+def mmdb_record(data: dict) -> tuple[str | None, ...]:
+    # Flatten a MaxMind city/asn record into the ipinfo.io fields
+    city: str | None = (data.get('city') or {}).get('names', {}).get('en')
+    subdivisions: list[dict] = data.get('subdivisions') or [{}]
+    region: str | None = subdivisions[0].get('names', {}).get('en')
+    country: str | None = (data.get('country') or {}).get('iso_code')
+    location: dict = data.get('location') or {}
+    loc: str | None = (
+        f"{location['latitude']:.4f},{location['longitude']:.4f}"
+        if 'latitude' in location and 'longitude' in location else None
+    )
+    org: str | None = data.get('autonomous_system_organization')
+
+    if org and data.get('autonomous_system_number'):
+        org = f"AS{data['autonomous_system_number']} {org}"  # ipinfo.io style org string
+
+    postal: str | None = (data.get('postal') or {}).get('code')
+    timezone: str | None = location.get('time_zone')
+    return city, region, country, loc, org, postal, timezone
@@ -0,0 +1,230 @@
+#!/nfs_share/matt_desktop/server_scripts/ip_profile/venv_311/bin/python3.11
+import re
+from typing import Iterable, Iterator, NamedTuple
+from datetime import date, datetime
+from functools import partial
+from log_files import LogScan, is_live, map_log_chunks, grep_log, read_chunk, http_line_date
+
+# Apache's combined format, and vhost_combined, which starts with 'vhost:port '. Quoted fields may hold escaped quotes.
+http_line_pattern: re.Pattern = re.compile(r'''
+    ^(?:(?P<vhost>\S+):\d+\ )?                  # matthewrobinsonmusic.com:443 (vhost_combined only)
+    (?P<ip>\S+)\ \S+\ \S+\                        # 1.2.3.4 - -
+    \[(?P<timestamp>[^\]]+)\]\                    # [17/Oct/2024:10:00:00 +0000]
+    "(?P<request>(?:[^"\\]|\\.)*)"\               # "GET /index.html HTTP/1.1"
+    (?P<status>\d{3})\ (?P<bytes>\d+|-)            # 200 512
+    (?:\ "(?P<referer>(?:[^"\\]|\\.)*)"           # "https://example.com/"
+    \ "(?P<agent>(?:[^"\\]|\\.)*)")?             # "Mozilla/5.0 ..."
+''', re.VERBOSE)
+
+
+class HttpRequest(NamedTuple):
+    ip: str
+    timestamp: str      # As logged, eg: '17/Oct/2024:10:00:00 +0000'
+    method: str | None  # None when the request line is not 'METHOD path protocol', eg: junk from scanners
+    path: str           # Without the query string
+    status: int
+    bytes: int
+    referer: str | None
+    agent: str | None
+    vhost: str | None   # Only logged by vhost_combined
+
+    @property
+    def time(self) -> str:
+        return self.timestamp[12:20]  # HH:MM:SS
+
+    @property
+    def day(self) -> str:
+        return self.timestamp[:11]  # Same format as http_log_date ('%d/%b/%Y')
+
+    @property
+    def epoch(self) -> int:
+        # Parsed when asked for. strptime() with %z cost about half the time of parsing a line, and no profiler uses it.
+        return int(datetime.strptime(self.timestamp, '%d/%b/%Y:%H:%M:%S %z').timestamp())
+
+
+class HttpRollup(NamedTuple):
+    # The requests of one ip to one vhost on one day, for one path and status. All that VhostVisits counts.
+    vhost: str
+    ip: str
+    day: str       # Same format as http_log_date ('%d/%b/%Y')
+    time: str      # HH:MM:SS of the first of the requests
+    path: str
+    status: int
+    requests: int
+    bytes: int
+
+
+def parse_http_line(line: str) -> HttpRequest | None:
+    # Returns None for lines that are not in the combined or vhost_combined format
+    match: re.Match | None = http_line_pattern.match(line)
+
+    if match is None:
+        return None
+
+    request: list[str] = match['request'].split()
+
+    if len(request) == 3:
+        method, path = request[0], request[1].split('?', 1)[0]
+    else:
+        method, path = None, match['request']
+
+    return HttpRequest(
+        ip=match['ip'],
+        timestamp=match['timestamp'],
+        method=method,
+        path=path,
+        status=int(match['status']),
+        bytes=0 if match['bytes'] == '-' else int(match['bytes']),
+        referer=match['referer'],
+        agent=match['agent'],
+        vhost=match['vhost']
+    )
+
+
+def find_vhost(line: str, pattern: re.Pattern | None, vhost: str | None = None) -> str | None:
+    # The vhost a log line belongs to: vhost, for files that only hold one, or the first match of pattern (see
+    # VhostDispatcher.register()). vhost_combined lines start with the vhost. Others only name it in a url.
+    if vhost:
+        return vhost
+
+    match: re.Match | None = pattern.search(line) if pattern else None
+    return match[0] if match else None
+
+
+def rollup_requests(lines: Iterable[str], pattern: re.Pattern | None, vhost: str | None = None) -> list[HttpRollup]:
+    # Parses lines and adds up their requests by vhost, ip, day, path and status, in the order each was first seen.
+    # Lines of no vhost (see find_vhost()) and lines that do not parse are dropped.
+    rollups: dict[tuple[str, str, str, str, int], list] = {}  # Key: [time, requests, bytes]
+
+    for line in lines:
+        line_vhost: str | None = find_vhost(line, pattern, vhost)
+
+        if line_vhost is None:
+            continue
+
+        request: HttpRequest | None = parse_http_line(line)
+
+        if request is None:
+            continue
+
+        rollup: list | None = rollups.get(key := (line_vhost, request.ip, request.day, request.path, request.status))
+
+        if rollup is None:
+            rollups[key] = [request.time, 1, request.bytes]
+        else:
+            rollup[0] = min(rollup[0], request.time)
+            rollup[1] += 1
+            rollup[2] += request.bytes
+
+    return [
+        HttpRollup(line_vhost, ip, day, time, path, status, requests, size)
+        for (line_vhost, ip, day, path, status), (time, requests, size) in rollups.items()
+    ]
+
+
+class VhostDispatcher(LogScan):
+    """Reads each http access log once and hands what was requested of every vhost to the consumers registered for
+    it. Before this, each vhost re-read and re-decompressed every log, so the cost grew with the number of vhosts.
+
+    The vhost of a line is found with one search of a regex built from every registered vhost name, which matches the
+    first vhost name on the line. Files that only hold one vhost (like nextcloud-access.log) can skip the search by
+    passing the vhost to run().
+
+    dispatcher = VhostDispatcher(http_log_date)
+    dispatcher.register('matthewrobinsonmusic', visits)
+    dispatcher.run(http_log_files)
+
+    Consumers are handed HttpRollups: the lines of each file are parsed and added up by vhost, ip, day, path and
+    status before they are dispatched, in the worker processes when there are any. rollups() yields them without
+    dispatching them, for use as the source of an ip_profile_lib.Pipeline."""
+
+    def __init__(self, log_date: str | None = None, reader=None, checkpoints=None, hold=None, day: date | None = None,
+                 cache=None):
+        super().__init__(log_date, reader, checkpoints, hold, day, cache)
+        self.consumers: dict[str, list] = {}
+        self.pattern: re.Pattern | None = None
+
+    def register(self, vhost: str, consumer) -> None:
+        # consumer is any callable taking an HttpRollup, or what a Pipeline made of it
+        self.consumers.setdefault(vhost, []).append(consumer)
+        # Longest names first, so a vhost whose name contains another vhost's name still wins
+        names: list[str] = sorted(self.consumers, key=len, reverse=True)
+        self.pattern = re.compile('|'.join(re.escape(name) for name in names))
+
+    def vhost_of(self, line: str) -> str | None:
+        return find_vhost(line, self.pattern)
+
+    def run(self, files: Iterable[str], vhost: str | None = None, workers: int | None = None) -> int:
+        # Returns the number of HttpRollups dispatched
+        dispatched: int = 0
+
+        for rollup in self.rollups(files, vhost, workers):
+            dispatched += self.dispatch(rollup)
+
+        return dispatched
+
+    def dispatch(self, rollup: HttpRollup) -> int:
+        # Hands rollup to the consumers registered for its vhost. Returns how many there were.
+        consumers: list = self.consumers.get(rollup.vhost, [])
+
+        for consumer in consumers:
+            consumer(rollup)
+
+        return len(consumers)
+
+    def rollups(self, files: Iterable[str], vhost: str | None = None,
+                workers: int | None = None) -> Iterator[HttpRollup]:
+        """The HttpRollups of log_date in files, for the registered vhosts. With more than one worker (default:
+        ip_profile_lib.parse_workers), files are parsed and added up by a pool of processes, which send back only
+        the rollups. They come in file order either way, though a pool sends one set of rollups per chunk of a file
+        rather than per file. The reader is only used for files read in this process."""
+        from ip_profile_lib import parse_workers, parse_chunk_size
+
+        workers = workers or parse_workers
+        files: list[str] = self.checkpoints.select(files) if self.checkpoints else list(files)
+
+        if workers > 1:
+            rollups: Iterable[HttpRollup] = map_log_chunks(
+                files, rollup_log_chunk,
+                (self.log_date, self.day, self.pattern and self.pattern.pattern, vhost), workers, parse_chunk_size,
+                local_files=[file for file in files if self.reads_locally(file)],
+                read_local=partial(self.rollups_of, vhost=vhost)
+            )
+        else:
+            rollups = (rollup for filename in files for rollup in self.rollups_of(filename, vhost))
+
+        for rollup in rollups:
+            if rollup.vhost in self.consumers:
+                yield rollup
+
+    def rollups_of(self, filename: str, vhost: str | None = None) -> Iterable[HttpRollup]:
+        # The HttpRollups of log_date in filename. Without a reader, other lines are skipped before they are decoded.
+        if self.checkpoints:
+            from ip_profile_lib import log_reader
+            lines: Iterable[str] = (self.reader or log_reader)(filename, self.checkpoints, self.hold)
+        elif self.reader:
+            lines = self.reader(filename)
+        elif self.parse_cache() and not is_live(filename):
+            return self.cached_rollups(filename, vhost)
+        else:
+            return rollup_requests(
+                grep_log(filename, (self.log_date,), day=self.day, line_date=http_line_date), self.pattern, vhost
+            )
+
+        return rollup_requests((line for line in lines if not self.log_date or self.log_date in line), self.pattern,
+                               vhost)
+
+    def cached_rollups(self, filename: str, vhost: str | None = None) -> Iterator[HttpRollup]:
+        # Kept per vhost name, or per set of registered names, since those decide which vhost each line belongs to
+        records: list[tuple] = self.cached_records(
+            filename, f'http {vhost or self.pattern and self.pattern.pattern}',
+            lambda filename: rollup_requests(read_chunk(filename), self.pattern, vhost)
+        )
+        return map(HttpRollup._make, records)
+
+
+def rollup_log_chunk(filename: str, start: int, end: int | None, log_date: str | None, day: date | None,
+                     pattern: str | None, vhost: str | None) -> list[HttpRollup]:
+    # Runs in a worker process of VhostDispatcher.run()
+    lines: Iterator[str] = grep_log(filename, (log_date,), start, end, day, http_line_date)
+    return rollup_requests(lines, pattern and re.compile(pattern), vhost)
@@ -5,6 +5,7 @@ from datetime import datetime, timedelta
 from matplotlib import pyplot as plt
 from os import remove, mkdir, system as run, chown
 from zipfile import ZipFile
+from ip_profile_lib import db_busy_timeout
 
 # Working directories.
 working_dir: str = '/nfs_share/matt_desktop/server_scripts/ip_profile'
@@ -37,9 +38,11 @@ except FileExistsError:
 
 # The body of this script will run four times. Once for every table in the database.
 for table in tables:
-    with sqlite3.connect(db_file) as con:
-        df: pd.DataFrame = pd.read_sql(f'select * from {table}', con)
-        df: pd.DataFrame = df[df.date.str.startswith(sql_date)]
+    with sqlite3.connect(db_file, timeout=db_busy_timeout) as con:  # Waits for a profiler that is writing
+        # Only the rows of last month are read, through the date index. Dates are 'YYYY-MM-DD' strings.
+        df: pd.DataFrame = pd.read_sql(
+            f'select * from {table} where date between ? and ?', con, params=(f'{sql_date}-01', f'{sql_date}-31')
+        )
 
     match table:
         case 'matthewrobinsonmusic' | 'nextcloud':
@@ -4,6 +4,7 @@ import sqlite3
 from datetime import datetime as dt, timedelta as td
 from matplotlib import pyplot as plt
 from os import system as run, remove, chown
+from ip_profile_lib import db_busy_timeout
 
 
 def trunc_str(string: str) -> str:
@@ -28,9 +29,11 @@ tables = ['nextcloud', 'matthewrobinsonmusic', 'f2b', 'ssh_user']
 date = dt.now().strftime('%Y-%m-%d')
 
 for table in tables:
-    with sqlite3.connect(db_file) as con:
-        df = pd.read_sql(f'select * from {table}', con)
-        df_week = df[df.date.isin(last_week)]
+    with sqlite3.connect(db_file, timeout=db_busy_timeout) as con:  # Waits for a profiler that is writing
+        # Only the rows of last week are read, through the date index
+        df_week = pd.read_sql(
+            f'select * from {table} where date between ? and ?', con, params=(last_week[0], last_week[-1])
+        )
 
     match table:
         case 'matthewrobinsonmusic' | 'nextcloud':
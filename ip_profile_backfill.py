@@ -0,0 +1,75 @@
+#!/nfs_share/matt_desktop/server_scripts/ip_profile/venv_311/bin/python3.11
+# Profiles every day from a start date to an end date (inclusive) with one read of the logs, eg: after an outage.
+# Each login and request is counted under the day it was logged, and each table is written once for all of the days.
+#
+#   ip_profile_backfill.py 2024-10-01 2024-10-07
+#
+# Runs the ssh, ssh accepted, vhosts and nextcloud profilers. The counts of days that were already profiled are
+# replaced by the ones read now, and accepted logins that are already stored are not added again.
+from sys import argv
+from datetime import date
+from http_log_parser import VhostDispatcher
+from ssh_log_parser import SshLogScan
+from log_files import ssh_line_date, http_line_date
+from ip_profile_ssh import FailedLogins
+from ip_profile_ssh_accepted import AcceptedLogins
+from ip_profile_vhosts import VhostVisits, vhost_pipeline
+from ip_profile_lib import (
+    EnrichmentPool, Pipeline, ssh_log_files, http_log_files, nextcloud_log_files, vhosts, log_manifest, ssh_sql_date,
+    lan_networks, finish_run, logger, hold_lease
+)
+
+if len(argv) != 3:
+    print(f'Usage: {argv[0]} START_DATE END_DATE  (YYYY-MM-DD)')
+    exit(1)
+
+start_date, end_date = date.fromisoformat(argv[1]), date.fromisoformat(argv[2])
+first_day, last_day = start_date.isoformat(), end_date.isoformat()  # Same format as the date column
+hold_lease('ssh_user', 'accepted_ssh', 'vhosts', 'nextcloud')  # Daily profilers of the same tables exit while it runs
+logger.info(f'Backfilling {first_day} to {last_day}')
+
+
+enrichment_pool = EnrichmentPool()  # Shared, so an ip seen by several profilers is only looked up once
+# Whole days are read, whatever incremental_logs is, so their counts replace the stored ones
+failed_logins = FailedLogins(enrichment_pool, incremental=False)
+accepted_logins = AcceptedLogins(enrichment_pool)
+visits = [VhostVisits(vhost, enrichment_pool, incremental=False) for vhost in vhosts]
+nextcloud_visits = VhostVisits('nextcloud', enrichment_pool, incremental=False)
+
+# No date prefilter or seek, since every day in the range is wanted. Rotated logs outside the range are still skipped.
+scan = SshLogScan(log_manifest.select(ssh_log_files, start_date, ssh_line_date, end_date))
+scan.register('failed', failed_logins)
+scan.register('accepted', accepted_logins)
+
+ssh_pipeline = Pipeline('ssh', scan.events())
+ssh_pipeline.filter('date', lambda event: first_day <= ssh_sql_date(event.day) <= last_day)
+ssh_pipeline.filter('trusted', lambda event: event.kind == 'accepted' or failed_logins.untrusted(event))
+ssh_pipeline.tap('enrich', lambda event: event.ip in lan_networks or enrichment_pool.submit(event.ip))
+ssh_pipeline.run(scan.dispatch)
+
+dispatcher = VhostDispatcher()
+
+for vhost_visits in visits:
+    dispatcher.register(vhost_visits.vhost, vhost_visits)
+
+http_pipeline = vhost_pipeline(
+    'vhosts', dispatcher, log_manifest.select(http_log_files, start_date, http_line_date, end_date), enrichment_pool,
+    date_range=(first_day, last_day)
+)
+http_pipeline.run(dispatcher.dispatch)
+
+nextcloud_dispatcher = VhostDispatcher()
+nextcloud_dispatcher.register('nextcloud', nextcloud_visits)
+nextcloud_pipeline = vhost_pipeline(
+    'nextcloud', nextcloud_dispatcher, log_manifest.select(nextcloud_log_files, start_date, http_line_date, end_date),
+    enrichment_pool, vhost='nextcloud', date_range=(first_day, last_day)
+)
+nextcloud_pipeline.run(nextcloud_dispatcher.dispatch)
+
+failed_logins.finish()
+accepted_logins.finish()
+
+for vhost_visits in visits + [nextcloud_visits]:
+    vhost_visits.finish()
+
+finish_run(None, enrichment_pool, ssh_pipeline, http_pipeline, nextcloud_pipeline)
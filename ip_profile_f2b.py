@@ -1,47 +1,26 @@
 #!/nfs_share/matt_desktop/server_scripts/ip_profile/venv_311/bin/python3.11
 from datetime import datetime as dt, timedelta as td
 import sqlite3
-import pandas as pd
 from ip_profile_lib import (
-    ip_info, db_con, logger, my_token, sql_date, ApiConnectionErrors, db_cursor, convert_to_sql_type, days
+    EnrichmentPool, Pipeline, trusted_ips, logger, sql_date, days, finish_run, ip_geo, event_table, upsert_rows,
+    transaction, hold_lease
 )
 
 # User defined vars
 db_f2b = '/var/lib/fail2ban/fail2ban.sqlite3'  # DB used by Fail2ban (default)
 con_f2b = sqlite3.connect(db_f2b)   # db created by f2b
 
+hold_lease('f2b')
 logger.info(" FAIL2BAN ".center(40, "#"))
 
-# Try to get table from database (if exists)
+# The api data of each ip is kept in ip_geo. The f2b view joins it with the bans.
 try:
-    df = pd.read_sql('select * from f2b', db_con)
-except pd.errors.DatabaseError as e:
-    error = e.args[0]
-
-    if 'no such table' in error.lower():  # No such table found. Creating now.
-        logger.info('Creating table')
-        db_cursor.execute('''
-            CREATE TABLE f2b (
-            ip TEXT,
-            city TEXT,
-            region TEXT,
-            country TEXT,
-            loc TEXT,
-            org TEXT,
-            postal TEXT,
-            timezone TEXT,
-            date TEXT,
-            hostname TEXT,
-            time TEXT,
-            anycast TEXT
-            )''')
-
-        df = pd.read_sql('select * from f2b', db_con)  # Blank data frame from new table
-    else:
-        logger.info('Failed to create table.')
-        logger.info(e)
-        logger.info('Exiting.')
-        exit()
+    event_table('f2b', {'date': 'TEXT', 'time': 'TEXT'}, key=('date', 'time'))
+except sqlite3.DatabaseError as e:
+    logger.info('Failed to create table.')
+    logger.info(e)
+    logger.info('Exiting.')
+    exit()
 
 # Dates and timestamps
 today_timestamp = dt.strptime(
@@ -51,47 +30,36 @@ today_timestamp = dt.strptime(
 yesterday_timestamp = dt.strptime((dt.now() - td(days=days)).strftime('%x'),'%x').timestamp()  # Yesterday midnight timestamp
 
 
-# Personal database with added ip information
-df_my_database = pd.read_sql('select * from f2b', db_con)
-# Database created by F2B
-df_f2b = pd.read_sql('select * from bips', con_f2b)
+def f2b_bans(start, end):
+    # Source stage. Every ip F2B banned between the start and end timestamps (UTC), with the time as HH:MM:SS.
+    for ip, time in con_f2b.execute('SELECT ip, timeofban FROM bips WHERE timeofban >= ? AND timeofban < ?',
+                                    (start, end)):
+        yield ip, dt.fromtimestamp(time).strftime('%H:%M:%S')
 
-# Find all F2B bans from yesterday. Use UTC timestamps
-df_f2b_yesterday = df_f2b[
-    (df_f2b.timeofban >= yesterday_timestamp) &
-    (df_f2b.timeofban < today_timestamp)
-]
 
 # A list of tuples containing ip addresses and the time they were banned yesterday
 bans = []
-for ip, time in zip(df_f2b_yesterday.ip, df_f2b_yesterday.timeofban):
-    time_formated = dt.fromtimestamp(time).strftime('%H:%M:%S')  # Convert timestamps to HH:MM:SS string format
-    bans.append((ip, time_formated))
+enrichment_pool = EnrichmentPool()
+pipeline = Pipeline('f2b', f2b_bans(yesterday_timestamp, today_timestamp))
+pipeline.filter('trusted', lambda ban: ban[0] not in trusted_ips)  # Trusted ips will not be recorded
+pipeline.tap('enrich', lambda ban: enrichment_pool.submit(ban[0]))
+pipeline.run(bans.append)
 
 if len(bans) == 0:
     logger.info('No new ips banned.')
 else:
-    for ban in bans:
-        try:
-            ip, time = ban                 # IP that was banned and the time of the ban
-            entry = ip_info(ip, my_token)  # Call the API func and get the data in a dict
-            entry['date'] = sql_date       # Yesterday's date
-            entry['time'] = time           # Time of ban
-            entry = convert_to_sql_type(entry)
-            df_entry = pd.DataFrame([entry])  # Convert to dataframe
-            # Concatenate new data with old data using pandas.concat()
-            df_my_database = pd.concat(objs=[df_my_database, df_entry], ignore_index=True)
-        except ApiConnectionErrors as e:
-            logger.info(e)
+    ip_data = enrichment_pool.results()  # Wait for the data of every banned ip
+
+    with transaction():  # The api data and bans are written together, or not at all
+        # IP that was banned, yesterday's date and the time of the ban
+        rows, failed_entries = ip_geo.link([{'ip': ip, 'date': sql_date, 'time': time} for ip, time in bans], ip_data)
+        upsert_rows('f2b_events', rows, key=('ip_id', 'date', 'time'))
+
+    for failed_entry in failed_entries:
+        logger.info(f'No api data for {failed_entry["ip"]}. Skipping.')
 
-    # Write new data to database
-    df_my_database.to_sql(
-        name='f2b', 
-        con=db_con,
-        if_exists='replace', 
-        index=False
-    )
     logger.info(f'{len(bans)} new f2b bans.')
 
 con_f2b.commit()
 con_f2b.close()
+finish_run(None, enrichment_pool, pipeline)
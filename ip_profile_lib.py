@@ -1,32 +1,66 @@
 #!/nfs_share/matt_desktop/server_scripts/ip_profile/venv_311/bin/python3.11
 import gzip
-import requests
 import logging
 from importlib import import_module
-from urllib3.exceptions import ReadTimeoutError, DecodeError
-from requests.exceptions import ReadTimeout, ContentDecodingError
+from functools import cached_property, lru_cache
+from contextlib import contextmanager
+import atexit
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator
 from os.path import isfile, isdir
-from os import listdir
-from datetime import datetime, timedelta
+from os import listdir, getpid
+from socket import gethostname
+from datetime import date, datetime, timedelta
 import pickle
 import sqlite3
 from admintools import MyLogger
+from geoip_backend import GeoIpIndex
+from http_log_parser import parse_http_line
+from log_files import LogCheckpoints, LogManifest, ParseCache, is_live, dated, ssh_line_date
+from ipaddress import ip_address, ip_network
+from bisect import bisect_right
 import json
+from time import time as now, monotonic, sleep, perf_counter
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, Future
+from random import uniform
+
+if TYPE_CHECKING:  # requests and urllib3 are only imported once an api call is made
+    import requests
 
 # User defined vars
 working_dir: str = '/nfs_share/matt_desktop/server_scripts/ip_profile'
-trusted_ips: list[str] = ['127.0.0.1', 'localhost', '::1']   # Trusted ips will not be recorded
-trusted_ips_file: str = f'{working_dir}/knownip.conf'        # Readable file with trusted ips. Or set to 'None'
+trusted_addresses: list[str] = ['127.0.0.1', 'localhost', '::1']  # Trusted ips will not be recorded. CIDR works too
+trusted_ips_file: str = f'{working_dir}/knownip.conf'        # Readable file with trusted ips/networks. Or set to 'None'
 api_token_file: str = f'{working_dir}/token.conf'            # File containing api token from ipinfo.io, or set to 'None'
 db_file: str = f'{working_dir}/ip_profile.db'                # A sqlite3 database to hold the data
 logger_file: str = '/var/log/ip_profile.log'                 # This script will log to this file
 vhosts: list[str] = ['matthewrobinsonmusic'] 				 # Each vhost can have its own table by the same name
-LAN_prefix: str = '192.168.1.'                               # IP addresses coming from LAN will be trusted and ignored
+LAN_networks: list[str] = ['192.168.1.0/24']                 # IP addresses coming from LAN will be trusted and ignored
 LAN_city: str = 'Atlanta'
 LAN_country: str = 'US'
 LAN_postal: str = '30315'
 LAN_region: str = 'Georgia'
 LAN_timezone: str = 'America/New_York'
+cache_ttl_days: int = 30                                     # Cached ip info older than this is fetched again
+cache_max_entries: int = 100_000                             # Least recently used ips beyond this are evicted
+ipinfo_url: str = 'https://ipinfo.io'                        # Base url of the api. Point at a stub server for testing
+batch_size: int = 100                                        # IPs per batch request (ipinfo.io allows up to 1000)
+api_rate_limit: float = 10.0                                 # Max api requests per second
+api_daily_quota: int = 1500                                  # Max ips looked up per day, shared by every profiler
+api_max_retries: int = 5                                     # Retries per request, with jittered exponential backoff
+enrich_workers: int = 4                                      # Threads resolving ips while the logs are being read
+api_timeout: tuple[float, float] = (5.0, 30.0)               # (connect, read) timeout in seconds for api requests
+api_http_retries: int = 3                                    # Retries on connection errors, inside each request
+geoip_database: str | None = None                            # Local ip-range database (.csv or .mmdb) to use instead
+                                                             # of the api. Ips it does not cover still go to the api.
+incremental_logs: bool = False                               # Only read the log lines added since the last run
+parse_workers: int = 1                                       # Processes parsing log files at once. 1 parses in-process
+parse_chunk_size: int = 64 * 2 ** 20                         # Plain logs larger than this (bytes) are split between them
+cache_parsed_logs: bool = True                               # Keep what was parsed from rotated logs, for reruns
+db_journal_mode: str = 'WAL'                                 # Lets the plots read while a profiler writes. Use 'DELETE'
+                                                             # if other hosts open db_file over NFS (unsafe with WAL)
+db_busy_timeout: float = 60.0                                # Seconds to wait for another run's writes to finish
+run_lease_seconds: int = 6 * 3600                            # A run that dies holding its lease blocks others this long
 
 if not isdir(working_dir):
     working_dir: str = './'
@@ -34,31 +68,14 @@ if not isdir(working_dir):
 
 # Log Dates - Some distros may log dates and times slightly differently
 days: int = 1  # how many days back to search in log ( 1 == yesterday )
-sql_date: str = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
+profile_day: date = (datetime.now() - timedelta(days=days)).date()
+sql_date: str = profile_day.strftime('%Y-%m-%d')
 http_log_date: str = (datetime.now() - timedelta(days=days)).strftime('%d/%b/%Y')
 ssh_log_date: str = (datetime.now() - timedelta(days=days)).strftime('%b %e')
-# sql connector
-db_con: sqlite3.Connection = sqlite3.connect(db_file)
-db_cursor: sqlite3.Cursor = db_con.cursor()
-
-
-my_token: str | None = None
-if api_token_file and isfile(api_token_file):
-    with open(api_token_file, 'r') as file:
-        my_tokens: list[str] = file.readlines()
-
-    for token in my_tokens:
-        # scroll through file for token. Ignore commented lines and pick the last token specified.
-        if not token.startswith('#'):
-            my_token = token
-
-    if '?token=' not in my_token:
-        my_token: str = '?token=' + my_token
-
-    for whitespace in ['\n', ' ', '\t', '\r']:
-        my_token = my_token.replace(whitespace, '')  # replace with nothing. Same as deleting
-else:
-    my_token: None = None
+# The days after the one being profiled. With incremental_logs, reading stops at their lines to leave them for later runs
+later_days: list[datetime] = [datetime.now() - timedelta(days=day) for day in range(days)]
+http_later_dates: tuple[str, ...] = tuple(day.strftime('[%d/%b/%Y:') for day in later_days)
+ssh_later_dates: tuple[str, ...] = tuple(day.strftime('%b %e') for day in later_days)
 
 
 class ApiError(Exception):
@@ -70,14 +87,129 @@ class ApiError(Exception):
         return self.message
 
 
-ApiConnectionErrors = (TimeoutError, ReadTimeoutError, ReadTimeout, ApiError, DecodeError, ContentDecodingError)
+class ApiQuotaExceeded(Exception):
+    def __init__(self, quota=None):
+        self.quota: int = quota
+        self.message: str = f'Daily api quota of {self.quota} lookups has been used up. Try again tomorrow.'
+
+    def __str__(self):
+        return self.message
+
+
+from_config: object = object()  # Default for arguments that are taken from config when the object is created
+http_session: 'requests.Session | None' = None
+http_session_lock: Lock = Lock()
+
+
+def get_session() -> 'requests.Session':
+    """The http session shared by every api call. It is created on first use and keeps connections to the api alive,
+    so each lookup does not pay for a new TCP and TLS handshake. Failed connections are retried here, but 429 and 5xx
+    responses are not: EnrichmentPool retries those, so each retry goes through its rate limit and daily quota. Pass
+    timeout=api_timeout with every request, since a session has no default."""
+    global http_session
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    with http_session_lock:  # The enrichment pool may ask for the session from several threads at once
+        if http_session is None:
+            retry: Retry = Retry(
+                total=api_http_retries,
+                backoff_factor=1,
+                status=0,                          # Responses are returned as they are, whatever their status
+                respect_retry_after_header=False,  # Left to EnrichmentPool too
+                raise_on_status=False,
+                allowed_methods=None,              # Retry the batch POST too. Lookups are idempotent.
+            )
+            adapter: HTTPAdapter = HTTPAdapter(
+                pool_connections=2,                     # ipinfo.io over https, and http without a token
+                pool_maxsize=max(10, enrich_workers),   # One kept-alive connection per enrichment thread
+                max_retries=retry
+            )
+            http_session = requests.Session()
+            http_session.mount('https://', adapter)
+            http_session.mount('http://', adapter)
+
+    return http_session
+
+
+class IpNetworkSet:
+    """A set of ip addresses and networks (CIDR blocks, IPv4 or IPv6) with fast membership tests.
+
+    Networks are merged into sorted, non-overlapping integer ranges, so `ip in networks` is a binary search instead of
+    a scan over every entry. Answers are memoized, since the same ips appear on many log lines. Entries that are not
+    ip addresses (like 'localhost') are matched literally."""
+
+    def __init__(self, entries=()):
+        self.networks: list = []
+        self.names: set[str] = set()
+        self.starts: dict[int, list[int]] = {4: [], 6: []}
+        self.ends: dict[int, list[int]] = {4: [], 6: []}
+        self.memo: dict[str, bool] = {}
+        self.built: bool = True
 
-logger: logging.Logger = MyLogger(
-    name='ip_profile',
-    to_file=logger_file,
-    to_console=True,
-    level=20
-).logger
+        for entry in entries:
+            self.append(entry)
+
+    def __repr__(self):
+        return f'IpNetworkSet({[str(network) for network in self.networks] + sorted(self.names)})'
+
+    def __len__(self) -> int:
+        return len(self.networks) + len(self.names)
+
+    def append(self, entry: str) -> None:
+        entry = entry.strip()
+
+        try:
+            self.networks.append(ip_network(entry, strict=False))
+        except ValueError:
+            self.names.add(entry)  # Not an ip address. Match it literally.
+
+        self.memo.clear()
+        self.built = False  # The ranges are rebuilt on the next lookup
+
+    def build(self) -> None:
+        self.built = True
+
+        for version in (4, 6):
+            ranges: list[tuple[int, int]] = sorted(
+                (int(network.network_address), int(network.broadcast_address))
+                for network in self.networks if network.version == version
+            )
+            self.starts[version], self.ends[version] = [], []
+
+            for start, end in ranges:
+                if self.ends[version] and start <= self.ends[version][-1] + 1:  # Overlapping or adjacent. Merge.
+                    self.ends[version][-1] = max(end, self.ends[version][-1])
+                else:
+                    self.starts[version].append(start)
+                    self.ends[version].append(end)
+
+    def __contains__(self, ip_addr: str) -> bool:
+        found: bool | None = self.memo.get(ip_addr)
+
+        if found is None:
+            found = self.lookup(ip_addr)
+            self.memo[ip_addr] = found
+
+        return found
+
+    def lookup(self, ip_addr: str) -> bool:
+        if not self.built:
+            self.build()
+
+        if ip_addr in self.names:
+            return True
+
+        try:
+            address = ip_address(ip_addr)
+        except ValueError:
+            return False
+
+        version: int = address.version
+        value: int = int(address)
+        position: int = bisect_right(self.starts[version], value) - 1
+        return position >= 0 and value <= self.ends[version][position]
 
 
 def convert_to_sql_type(dictionary: dict) -> dict:
@@ -117,21 +249,180 @@ def os_release() -> dict[str, str]:
     return release
 
 
-def ip_info(ip_address, token=None) -> dict[str, str | int]:
+class IpCache:
+    """A persistent cache of api responses, stored in the ip_cache table of db_file. The same scanners show up day
+    after day and across every profiler, so most lookups never need to reach ipinfo.io. Entries older than ttl_days
+    are treated as a miss and refreshed. Once the table holds more than max_entries rows, the least recently used
+    ips are evicted."""
+
+    def __init__(self, con: sqlite3.Connection, ttl_days: int = cache_ttl_days, max_entries: int = cache_max_entries):
+        self.con: sqlite3.Connection = con
+        self.ttl: float = ttl_days * 86400  # seconds
+        self.max_entries: int = max_entries
+        self.hits: int = 0
+        self.misses: int = 0
+        self.touched: set[str] = set()  # ips read from the cache during this run. last_used is updated on flush()
+
+    def get(self, ip_addr: str) -> dict[str, str | int] | None:
+        row: tuple[str, float] | None = self.con.execute(
+            'SELECT data, fetched FROM ip_cache WHERE ip = ?', (ip_addr,)
+        ).fetchone()
+
+        if row is None or row[1] < now() - self.ttl:  # Never seen, or stale and due for a refresh
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.touched.add(ip_addr)
+        return json.loads(row[0])
+
+    def put(self, ip_addr: str, data: dict[str, str | int], commit: bool = True) -> None:
+        if 'error' in data:  # Do not remember failed lookups
+            return
+
+        timestamp: float = now()
+        self.con.execute(
+            'INSERT OR REPLACE INTO ip_cache (ip, data, fetched, last_used) VALUES (?, ?, ?, ?)',
+            (ip_addr, json.dumps(data), timestamp, timestamp)
+        )
+
+        if commit:
+            self.con.commit()
+
+    def evict(self) -> int:
+        # Drop expired entries first, then the least recently used ones above max_entries
+        cursor: sqlite3.Cursor = self.con.execute('DELETE FROM ip_cache WHERE fetched < ?', (now() - self.ttl,))
+        evicted: int = cursor.rowcount
+        cursor = self.con.execute('''
+            DELETE FROM ip_cache WHERE ip IN (
+            SELECT ip FROM ip_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?
+            )''', (self.max_entries,))
+        evicted += cursor.rowcount
+        self.con.commit()
+        return evicted
+
+    def flush(self) -> None:
+        # Call once at the end of a run. Records usage, applies the eviction policy and reports hits and misses.
+        timestamp: float = now()
+        self.con.executemany(
+            'UPDATE ip_cache SET last_used = ? WHERE ip = ?',
+            [(timestamp, ip_addr) for ip_addr in self.touched]
+        )
+        self.touched.clear()
+        evicted: int = self.evict()
+
+        lookups: int = self.hits + self.misses
+        hit_rate: float = (self.hits / lookups * 100) if lookups else 0.0
+        config.logger.info(f'IP cache: {self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hit rate). '
+                           f'{evicted} entries evicted.')
+
+
+class IpGeo:
+    """The ip_geo table of db_file: the api data of each ip, stored once for every profiler and day, under an integer
+    id. The event tables (see event_table()) keep that id instead of their own copy of the data, so refreshing the
+    data of an ip is a one row update. refreshed is when the api sent the data, as kept in ip_cache, and NULL for data
+    moved over from the wide tables of before."""
+
+    def __init__(self, con: sqlite3.Connection):
+        self.con: sqlite3.Connection = con
+
+    def ids(self, ip_addrs: Iterable[str]) -> dict[str, int]:
+        ip_addrs: list[str] = list(set(ip_addrs))
+        ids: dict[str, int] = {}
+
+        for start in range(0, len(ip_addrs), 500):  # Stays under the limit on ? parameters per statement
+            chunk: list[str] = ip_addrs[start:start + 500]
+            placeholders: str = ', '.join('?' * len(chunk))
+            ids.update(self.con.execute(f'SELECT ip, id FROM ip_geo WHERE ip IN ({placeholders})', chunk))
+
+        return ids
+
+    def put(self, ip_data: dict[str, dict]) -> dict[str, int]:
+        # Writes the api data of each ip (ip: data), and returns their ids. refreshed is taken from the fetched time of
+        # the ip in ip_cache, since data from a cache hit can be up to cache_ttl_days old. Data the api did not send,
+        # eg: from the offline database or for the LAN, keeps the refreshed it had.
+        rows: list[dict] = [{**convert_to_sql_type(dict(data)), 'ip': ip} for ip, data in ip_data.items()]
+        upsert_rows('ip_geo', rows, key=('ip',), con=self.con)
+        ids: dict[str, int] = self.ids(ip_data)
+        self.con.executemany(
+            'UPDATE ip_geo SET refreshed = coalesce((SELECT fetched FROM ip_cache WHERE ip = ip_geo.ip), refreshed) '
+            'WHERE id = ?', [(ip_id,) for ip_id in ids.values()]
+        )
+        return ids
+
+    def link(self, rows: list[dict], ip_data: dict[str, dict]) -> tuple[list[dict], list[dict]]:
+        """Profilers count their rows without api data while reading the logs, then resolve all the new ips in one
+        batch. This writes the api data of the ips of rows (ip_data, ip: data) and swaps the ip of each row for its id.
+        Rows whose ip could not be resolved are left out and returned in a second list, so they can be passed on to
+        handle_failed_requests()."""
+        ids: dict[str, int] = self.put({row['ip']: ip_data[row['ip']] for row in rows if row['ip'] in ip_data})
+        linked: list[dict] = []
+        failed: list[dict] = []
+
+        for row in rows:
+            if row['ip'] in ids:
+                linked.append({'ip_id': ids[row['ip']], **{key: val for key, val in row.items() if key != 'ip'}})
+            else:
+                failed.append(row)
+
+        return linked, failed
+
+
+geoip_index: GeoIpIndex | None = None
+
+
+def load_geoip_index() -> GeoIpIndex | None:
+    # The offline database is only loaded if it is configured, and only once per run
+    global geoip_index
+
+    if geoip_index is None and geoip_database:
+        geoip_index = GeoIpIndex.load(geoip_database)
+        config.logger.debug(f'Loaded {len(geoip_index)} ip ranges from {geoip_database}')
+
+    return geoip_index
+
+
+def ip_info(ip_address, token=None, use_cache=True) -> dict[str, str | int]:
     # API provided by ipinfo.io
     # Returns a dict with information about the given ip address. Keys include :
     # ip, hostname, city, region, country, loc, org, postal, timezone, and more...
+    # 429 and 5xx responses raise requests.HTTPError. They are not retried here: only EnrichmentPool retries them.
+    if load_geoip_index():
+        data: dict[str, str | int] | None = geoip_index.lookup(ip_address)
+
+        if data is not None:
+            return data
+
+    if use_cache:
+        data: dict[str, str | int] | None = config.ip_cache.get(ip_address)
+
+        if data is not None:
+            return data
+
     if token:
-        api: str = 'https://ipinfo.io/' + ip_address + token  # HTTPS
+        api: str = f'{ipinfo_url.rstrip("/")}/{ip_address}{token}'
     else:
-        api: str = 'http://ipinfo.io/' + ip_address  # HTTP (data limits may apply)
+        api: str = f'{ipinfo_url.rstrip("/")}/{ip_address}'  # No token (data limits apply)
 
-    return requests.get(api).json()
+    response = get_session().get(api, timeout=api_timeout)
+
+    if response.status_code == 429 or response.status_code >= 500:  # Not api data, so not cached either
+        response.raise_for_status()
+
+    data: dict[str, str | int] = response.json()
+
+    if use_cache:
+        config.ip_cache.put(ip_address, data)
+
+    return data
 
 
 class IpInfoApi:
-    def __init__(self, token=my_token):
-        self.token: str = token
+    def __init__(self, token=from_config, cache=from_config, base_url=from_config, geoip=None):
+        self.token: str | None = config.my_token if token is from_config else token
+        self.cache: IpCache | None = config.ip_cache if cache is from_config else cache  # None to always use the api
+        self.base_url: str = (ipinfo_url if base_url is from_config else base_url).rstrip('/')
+        self.geoip: GeoIpIndex | None = geoip or load_geoip_index()  # Answers lookups locally when configured
         self.failed_requests: list[dict] = []
         self.successful_requests: list[dict] = []
         self.count_requests: int = 0
@@ -140,22 +431,509 @@ class IpInfoApi:
         # API provided by ipinfo.io
         # Returns a dict with information about the given ip address. Keys include :
         # ip, hostname, city, region, country, loc, org, postal, timezone, and more...
-        if self.token:
-            api: str = 'https://ipinfo.io/' + ip_addr + self.token  # HTTPS
-        else:
-            api: str = 'http://ipinfo.io/' + ip_addr  # HTTP (data limits apply)
+        data: dict | None = self.local_lookup(ip_addr)
+
+        if data is not None:
+            return data
+
+        return self._fetch(ip_addr)
+
+    def local_lookup(self, ip_addr) -> dict[str, str | int] | None:
+        # Answer from the offline database or the cache without touching the network. None if neither has the ip.
+        if self.geoip:
+            data: dict | None = self.geoip.lookup(ip_addr)
 
+            if data is not None:
+                return data
+
+        if self.cache:
+            return self.cache.get(ip_addr)
+
+        return None
+
+    def _fetch(self, ip_addr) -> dict[str, str | int]:
+        # Query the api directly, skipping the cache lookup. The response is still saved to the cache.
         self.count_requests += 1
-        data: dict = requests.get(api).json()
+        data: dict = self._get(ip_addr)
         self.successful_requests.append(data)
+
+        if self.cache:
+            self.cache.put(ip_addr, data)
+
         return data
 
+    def _get(self, ip_addr) -> dict[str, str | int]:
+        # A single http request with no cache or bookkeeping, so it is safe to call from worker threads
+        if self.token:
+            api: str = f'{self.base_url}/{ip_addr}{self.token}'
+        else:
+            api: str = f'{self.base_url}/{ip_addr}'  # No token (data limits apply)
+
+        response = get_session().get(api, timeout=api_timeout)
+
+        if response.status_code == 429 or response.status_code >= 500:  # Worth retrying, eg: by EnrichmentPool
+            response.raise_for_status()
+
+        return response.json()
+
+    def _post_batch(self, ip_addrs: list[str]) -> dict[str, dict]:
+        # A single batch request with no cache or bookkeeping, so it is safe to call from worker threads
+        response = get_session().post(f'{self.base_url}/batch{self.token}', json=ip_addrs, timeout=api_timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def batch_request(self, ip_addrs, chunk_size=batch_size, on_error='single') -> dict[str, dict[str, str | int]]:
+        """Resolve many addresses at once through the ipinfo.io batch endpoint. Duplicates and cached ips are
+        removed first, and the rest are sent in chunks of chunk_size. Returns a dict of ip -> api data. Ips that could
+        not be resolved are left out of the result and recorded in self.failed_requests.
+
+        on_error decides what happens when a chunk fails, or when the response is missing some of its ips:
+            'single' -- retry each of those ips with its own request
+            'skip'   -- record them as failed and move on to the next chunk
+            'raise'  -- re-raise the error (or raise ApiError for a missing ip)"""
+
+        if on_error not in ('single', 'skip', 'raise'):
+            raise ValueError(f'Unknown on_error policy: {on_error}')
+
+        results: dict[str, dict] = {}
+        pending: list[str] = []
+
+        for ip_addr in dict.fromkeys(ip_addrs):  # de-duplicate, keeping the original order
+            data: dict | None = self.local_lookup(ip_addr)
+
+            if data is None:
+                pending.append(ip_addr)
+            else:
+                results[ip_addr] = data
+
+        if not self.token:  # The batch endpoint requires a token. Fall back to one request per ip.
+            chunk_size: int = 1
+
+        for start in range(0, len(pending), chunk_size):
+            data, failed = self.resolve_chunk(pending[start:start + chunk_size], on_error, self._counted)
+            results.update(data)
+            self.store(data)
+            self.failed_requests.extend(failed)
+
+        return results
+
+    def resolve_chunk(self, chunk: list[str], on_error: str = 'single',
+                      send: Callable | None = None) -> tuple[dict[str, dict], list[dict]]:
+        """The api data of the ips of chunk (ip: data), and a list of the ones that could not be resolved. Only makes
+        the http requests, with no cache or bookkeeping, so it is safe to call from worker threads. Chunks of more
+        than one ip are sent as a batch request, and on_error (see batch_request()) decides what happens to the ips
+        it did not resolve. send(request, arg, lookups) makes each request, eg: with rate limiting and retries."""
+        send = send or (lambda request, arg, lookups=1: request(arg))
+        errors: tuple[type[Exception], ...] = config.api_connection_errors + (ValueError, ApiQuotaExceeded)
+        data: dict[str, dict] = {}
+        failed: list[dict] = []
+        unresolved: list[str] = chunk
+
+        if len(chunk) > 1:
+            try:
+                response: dict[str, dict] = send(self._post_batch, chunk, len(chunk))
+            except errors as error:  # ValueError -- response was not valid json
+                if on_error == 'raise':
+                    raise
+                config.logger.error(f'Batch request of {len(chunk)} ips failed: {error}')
+                response: dict[str, dict] = {}
+
+            unresolved = []
+
+            for ip_addr in chunk:
+                entry: dict | None = response.get(ip_addr)
+
+                if isinstance(entry, dict) and 'error' not in entry:
+                    data[ip_addr] = entry
+                else:
+                    unresolved.append(ip_addr)
+
+            if unresolved and on_error == 'raise':
+                raise ApiError(unresolved[0])
+            elif on_error == 'skip':
+                return data, [{'ip': ip_addr, 'error': 'missing from batch response'} for ip_addr in unresolved]
+
+        for ip_addr in unresolved:  # One request per ip
+            try:
+                entry: dict = send(self._get, ip_addr, 1)
+            except errors as error:
+                if on_error == 'raise':
+                    raise
+                failed.append({'ip': ip_addr, 'error': str(error)})
+                continue
+
+            if 'error' not in entry:
+                data[ip_addr] = entry
+            elif on_error == 'raise':
+                raise ApiError(ip_addr)
+            else:
+                failed.append({'ip': ip_addr, 'error': str(entry['error'])})
+
+        return data, failed
+
+    def store(self, data: dict[str, dict]) -> None:
+        # Keeps the api data of resolved ips (ip: data) in successful_requests and the cache. Not thread safe.
+        for ip_addr, entry in data.items():
+            self.successful_requests.append(entry)
+
+            if self.cache:
+                self.cache.put(ip_addr, entry, commit=False)
+
+        if self.cache:
+            self.cache.con.commit()
+
+    def _counted(self, request, arg, lookups: int = 1):
+        self.count_requests += 1
+        return request(arg)
+
     def check_failed_requests(self) -> bool:
         return len(self.failed_requests) > 0
 
 
-def log_reader(filename):
-    if filename.endswith('.gz'):
+class TokenBucket:
+    """Limits api calls to `rate` requests per second, allowing short bursts of up to `capacity` requests. It also keeps
+    a daily budget of ip lookups, shared by every profiler through the api_usage table. Thread safe."""
+
+    def __init__(self, rate: float = api_rate_limit, capacity: int | None = None,
+                 daily_quota: int | None = api_daily_quota, used_today: int = 0):
+        self.rate: float = rate
+        self.capacity: float = capacity or max(1.0, rate)
+        self.tokens: float = self.capacity
+        self.daily_quota: int | None = daily_quota  # None for no daily limit
+        self.used_today: int = used_today
+        self.updated: float = monotonic()
+        self.lock: Lock = Lock()
+
+    def acquire(self, lookups: int = 1) -> None:
+        # Block until a request may be sent. Raises ApiQuotaExceeded if the lookups would go over the daily budget.
+        while True:
+            with self.lock:
+                if self.daily_quota is not None and self.used_today + lookups > self.daily_quota:
+                    raise ApiQuotaExceeded(self.daily_quota)
+
+                current: float = monotonic()
+                self.tokens = min(self.capacity, self.tokens + (current - self.updated) * self.rate)
+                self.updated = current
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    self.used_today += lookups
+                    return
+
+                wait: float = (1 - self.tokens) / self.rate
+
+            sleep(wait)
+
+
+class EnrichmentPool:
+    """Resolves ips with the api in background threads, so the logs keep streaming while lookups are in flight.
+    Profilers submit() each new ip as they find it, and collect everything with results() once the logs are read.
+
+    Ips found in the cache or the offline database are answered straight away. The rest are queued, and every
+    chunk_size ips are sent to a worker as one batch request (or one request per ip without a token), through
+    IpInfoApi.resolve_chunk() with the on_error policy of batch_request(). Requests are paced by a TokenBucket, and
+    failed requests are retried with jittered exponential backoff. The cache and database are only touched from the
+    calling thread."""
+
+    def __init__(self, api: IpInfoApi | None = None, workers: int = enrich_workers, chunk_size: int = batch_size,
+                 bucket: TokenBucket | None = None, max_retries: int = api_max_retries, backoff_base: float = 1.0,
+                 backoff_cap: float = 60.0, on_error: str = 'single'):
+        if on_error not in ('single', 'skip', 'raise'):
+            raise ValueError(f'Unknown on_error policy: {on_error}')
+
+        self.api: IpInfoApi = api or IpInfoApi()
+        self.on_error: str = on_error
+        self.chunk_size: int = chunk_size if self.api.token else 1  # The batch endpoint requires a token
+        self.max_retries: int = max_retries
+        self.backoff_base: float = backoff_base  # seconds
+        self.backoff_cap: float = backoff_cap    # seconds
+        self.executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='enrich')
+        self.futures: list[Future] = []
+        self.pending: list[str] = []
+        self.seen: set[str] = set()
+        self.resolved: dict[str, dict] = {}
+        self.failed_requests: list[dict] = []
+        self.today: str = datetime.now().strftime('%Y-%m-%d')
+
+        if self.api.cache:
+            row: tuple[int] | None = self.api.cache.con.execute(
+                'SELECT lookups FROM api_usage WHERE date = ?', (self.today,)
+            ).fetchone()
+            used_today: int = row[0] if row else 0
+        else:
+            used_today: int = 0
+
+        self.used_before: int = used_today
+        self.bucket: TokenBucket = bucket or TokenBucket(used_today=used_today)
+
+    def submit(self, ip_addr: str) -> None:
+        if ip_addr in self.seen:
+            return
+
+        self.seen.add(ip_addr)
+        data: dict | None = self.api.local_lookup(ip_addr)
+
+        if data is None:
+            self.pending.append(ip_addr)
+
+            if len(self.pending) >= self.chunk_size:
+                self._dispatch()
+        else:
+            self.resolved[ip_addr] = data
+
+    def results(self) -> dict[str, dict]:
+        # Wait for every lookup submitted so far. Returns ip -> api data for every ip that was resolved.
+        if self.pending:
+            self._dispatch()
+
+        for future in self.futures:
+            data, failed = future.result()
+            self.failed_requests.extend(failed)
+            self.resolved.update(data)
+            self.api.store(data)
+
+        self.futures.clear()
+        return self.resolved
+
+    def close(self) -> None:
+        self.results()
+        self.executor.shutdown()
+
+        lookups: int = self.bucket.used_today - self.used_before
+
+        if self.api.cache:  # Add this run's lookups to today's, so profilers running at once do not overwrite them
+            self.api.cache.con.execute(
+                'INSERT INTO api_usage (date, lookups) VALUES (?, ?) '
+                'ON CONFLICT (date) DO UPDATE SET lookups = lookups + excluded.lookups', (self.today, lookups)
+            )
+            self.api.cache.con.commit()
+
+        config.logger.info(f'Api: {lookups} lookups, {len(self.failed_requests)} failed.')
+
+    def _dispatch(self) -> None:
+        chunk: list[str] = self.pending
+        self.pending = []
+        self.futures.append(self.executor.submit(self._resolve_chunk, chunk))
+
+    def _resolve_chunk(self, chunk: list[str]) -> tuple[dict[str, dict], list[dict]]:
+        # Runs in a worker thread
+        return self.api.resolve_chunk(chunk, self.on_error, self._with_retries)
+
+    def _with_retries(self, request, arg, lookups: int = 1):
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire(lookups)
+
+            try:
+                return request(arg)
+            except config.api_connection_errors + (ValueError,) as error:
+                if attempt == self.max_retries:
+                    raise
+
+                delay: float = uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))  # full jitter
+                retry_after: str = getattr(getattr(error, 'response', None), 'headers', {}).get('Retry-After', '')
+
+                if retry_after.isdigit():  # A 429 or 503 that says how long to wait
+                    delay = min(self.backoff_cap, max(delay, float(retry_after)))
+
+                config.logger.warning(f'Api request failed ({error}). Retrying in {delay:.1f}s')
+                sleep(delay)
+
+
+class Stage:
+    def __init__(self, name: str):
+        self.name: str = name
+        self.items: int = 0       # Items passed on to the next stage
+        self.seconds: float = 0.0  # Time spent getting those items, including the time of the stages before it
+
+
+class Pipeline:
+    """Runs the items of a source through a chain of generator stages into a sink. The profilers are built from it:
+
+    pipeline = Pipeline('ssh', scan.events())                          # Reader and parser
+    pipeline.filter('trusted', lambda event: event.ip not in trusted_ips)
+    pipeline.tap('enrich', lambda event: enrichment_pool.submit(event.ip))  # Api lookups start in the background
+    pipeline.run(failed_logins)                                        # Aggregator. It writes to the database later
+    pipeline.report()
+
+    Each stage pulls items one at a time from the stage before it, so nothing runs ahead of what the sink has taken
+    and no log is ever held in memory. Every stage counts the items it passes on and the time spent in it, which
+    report() logs, to show where a run spends its time."""
+
+    def __init__(self, name: str, source: Iterable):
+        self.name: str = name
+        self.stages: list[Stage] = []
+        self.items: Iterator = self._timed('source', iter(source))
+
+    def pipe(self, name: str, stage: Callable[[Iterator], Iterator]) -> 'Pipeline':
+        # Adds a stage. stage is a generator function taking the items of the stage before
+        self.items = self._timed(name, stage(self.items))
+        return self
+
+    def map(self, name: str, function: Callable) -> 'Pipeline':
+        return self.pipe(name, lambda items: map(function, items))
+
+    def filter(self, name: str, predicate: Callable[..., bool]) -> 'Pipeline':
+        return self.pipe(name, lambda items: filter(predicate, items))
+
+    def tap(self, name: str, function: Callable) -> 'Pipeline':
+        # Calls function on every item for its side effect, and passes the item on unchanged
+        def tapped(items: Iterator) -> Iterator:
+            for item in items:
+                function(item)
+                yield item
+
+        return self.pipe(name, tapped)
+
+    def run(self, sink: Callable) -> int:
+        # Hands every item to sink. Returns the number of items.
+        stage: Stage = Stage('sink')
+        self.stages.append(stage)
+
+        for item in self.items:
+            start: float = perf_counter()
+            sink(item)
+            stage.seconds += perf_counter() - start
+            stage.items += 1
+
+        return stage.items
+
+    def report(self) -> None:
+        upstream: float = 0.0
+        timings: list[str] = []
+
+        for stage in self.stages:
+            own: float = stage.seconds if stage.name == 'sink' else stage.seconds - upstream
+            upstream = stage.seconds if stage.name != 'sink' else upstream
+            timings.append(f'{stage.name} {stage.items} ({own:.3f}s)')
+
+        config.logger.info(f'Pipeline {self.name}: {" > ".join(timings)}')
+
+    def _timed(self, name: str, items: Iterator) -> Iterator:
+        stage: Stage = Stage(name)
+        self.stages.append(stage)
+        return self._count(stage, items)
+
+    @staticmethod
+    def _count(stage: Stage, items: Iterator) -> Iterator:
+        while True:
+            start: float = perf_counter()
+
+            try:
+                item = next(items)
+            except StopIteration:
+                stage.seconds += perf_counter() - start
+                return
+
+            stage.seconds += perf_counter() - start
+            stage.items += 1
+            yield item
+
+
+def table_columns(table: str, con: sqlite3.Connection | None = None) -> list[str]:
+    return [row[1] for row in (con or config.db_con).execute(f'PRAGMA table_info({table})')]
+
+
+def unique_key(table: str, key: tuple[str, ...]) -> None:
+    """Makes the unique index upsert_rows() needs on the natural key of a table. Tables written before the index
+    existed can hold rows with the same key, eg: f2b after a rerun, so all but the first of those are dropped."""
+    con: sqlite3.Connection = config.db_con
+    index: str = f'{table}_key'
+
+    if any(row[1] == index for row in con.execute(f'PRAGMA index_list({table})')):
+        return
+
+    columns: str = ', '.join(key)
+
+    with transaction(con):
+        deleted: int = con.execute(
+            f'DELETE FROM {table} WHERE rowid NOT IN (SELECT min(rowid) FROM {table} GROUP BY {columns})'
+        ).rowcount
+        con.execute(f'CREATE UNIQUE INDEX {index} ON {table} ({columns})')
+
+    if deleted:
+        config.logger.warning(f'Dropped {deleted} duplicate rows from {table}')
+
+
+def upsert_rows(table: str, rows: list[dict], key: tuple[str, ...] = (), add: tuple[str, ...] = (),
+                keep: tuple[str, ...] = (), merge: dict[str, str] | None = None,
+                con: sqlite3.Connection | None = None) -> int:
+    """Writes rows (dicts of column: value) into table in one transaction, and returns how many there were. Only
+    these rows are touched, so the cost does not grow with the history in the table.
+
+    With a key (see unique_key()), a row whose key is already in the table is merged into the stored row: columns in
+    add are summed, columns in keep keep the stored value, merge maps a column to its own SQL expression (of the
+    stored column and excluded.column), and any other column takes the new value unless it is NULL. Without a key the
+    rows are only inserted. Columns the table does not have yet, eg: new api fields, are added to it. Inside a
+    transaction(), the rows are part of it."""
+    if not rows:
+        return 0
+
+    con = con or config.db_con
+    columns: list[str] = list(dict.fromkeys(column for row in rows for column in row))
+    values: list[tuple] = [
+        tuple(None if isinstance(val, float) and val != val else val for val in map(row.get, columns))  # NaN to NULL
+        for row in rows
+    ]
+    stored: list[str] = table_columns(table, con)
+    sql: str = f'INSERT INTO {table} ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})'
+
+    if key:
+        updates: list[str] = []
+
+        for column in columns:
+            if column in key:
+                continue
+            elif merge and column in merge:
+                updates.append(f'{column} = {merge[column]}')
+            elif column in add:
+                updates.append(f'{column} = {table}.{column} + excluded.{column}')
+            elif column in keep:
+                updates.append(f'{column} = coalesce({table}.{column}, excluded.{column})')
+            else:
+                updates.append(f'{column} = coalesce(excluded.{column}, {table}.{column})')
+
+        action: str = f'DO UPDATE SET {", ".join(updates)}' if updates else 'DO NOTHING'  # Every column is in the key
+        sql += f' ON CONFLICT ({", ".join(key)}) {action}'
+
+    with transaction(con):
+        for i, column in enumerate(columns):
+            if column not in stored:
+                value: object = next((row[i] for row in values if row[i] is not None), None)
+                sql_type: str = {bool: 'INTEGER', int: 'INTEGER', float: 'REAL'}.get(type(value), 'TEXT')
+                con.execute(f'ALTER TABLE {table} ADD COLUMN {column} {sql_type}')
+
+        con.executemany(sql, values)
+
+    return len(rows)
+
+
+def event_table(name: str, columns: dict[str, str], key: tuple[str, ...] = (), details: str = '') -> str:
+    """Creates the lean table {name}_events of a profiler: the id of the ip in ip_geo, then columns (name: type),
+    unique on the ip and key. A view by the old name joins it back with ip_geo, so queries on the wide tables of
+    before (select * from ssh_user) still work. details adds columns to the view, as SQL over the events (e), eg:
+    from a child table. The indexes of event_indexes() are made with it. The wide tables themselves were moved into
+    ip_geo and the events tables by the move_wide_tables migration. Returns the name of the new table."""
+    con: sqlite3.Connection = config.db_con
+    events: str = f'{name}_events'
+    column_sql: str = ',\n'.join(f'{column} {sql_type}' for column, sql_type in columns.items())
+    con.execute(f'CREATE TABLE IF NOT EXISTS {events} (\nip_id INTEGER REFERENCES ip_geo (id),\n{column_sql}\n)')
+    con.commit()
+
+    if key:
+        unique_key(events, ('ip_id', *key))
+
+    event_indexes(events, con)
+    con.execute(f'DROP VIEW IF EXISTS {name}')  # Remade each time, as its details may have changed
+    con.execute(f'CREATE VIEW {name} AS SELECT g.*, e.*{details} FROM {events} e JOIN ip_geo g ON g.id = e.ip_id')
+    con.commit()
+    return events
+
+
+def log_reader(filename, checkpoints: LogCheckpoints | None = None, hold=None):
+    # With checkpoints, live log files are only read from where the last run stopped (see log_files.LogCheckpoints)
+    if checkpoints is not None and is_live(filename):
+        yield from checkpoints.read(filename, hold)
+    elif filename.endswith('.gz'):
         with gzip.open(filename, 'rb') as fh:
             for line in fh:
                 yield line.decode()
@@ -165,6 +943,350 @@ def log_reader(filename):
                 yield line
 
 
+def is_later_ssh_line(line: str) -> bool:
+    return line.startswith(ssh_later_dates)
+
+
+def is_later_http_line(line: str) -> bool:
+    return any(date in line for date in http_later_dates)
+
+
+@lru_cache(maxsize=1024)
+def ssh_sql_date(day: str) -> str:
+    # 'Oct 17' (SshEvent.day) to '2024-10-17'. Syslog leaves out the year, so it is the latest one not in the future.
+    return dated(day, ssh_line_date, date.today()).isoformat()
+
+
+@lru_cache(maxsize=1024)
+def http_day_sql_date(day: str) -> str:
+    # '17/Oct/2024' (HttpRollup.day) to '2024-10-17'
+    return datetime.strptime(day, '%d/%b/%Y').strftime('%Y-%m-%d')
+
+
+def logs_for_day(files, line_date) -> list[str]:
+    # Leaves out rotated logs with no lines from profile_day. line_date is log_files.ssh_line_date or http_line_date
+    return config.log_manifest.select(files, profile_day, line_date)
+
+
+def log_checkpoints(name: str) -> LogCheckpoints | None:
+    # The read checkpoints of a profiler, or None when incremental_logs is off and every log is read in full
+    return LogCheckpoints(config.db_con, name) if incremental_logs else None
+
+
+def finish_run(checkpoints: LogCheckpoints | None, pool: 'EnrichmentPool', *pipelines: 'Pipeline') -> None:
+    # The end of a profiler's run, once its rows are written
+    if checkpoints:  # Saved last, so lines are only skipped next run once they are in the database
+        checkpoints.commit()
+
+    pool.close()
+    config.ip_cache.flush()
+
+    for pipeline in pipelines:
+        pipeline.report()
+
+
+def connect(filename: str | None = None) -> sqlite3.Connection:
+    """Opens db_file (or filename) set up for several scripts sharing it. In WAL mode readers and a writer do not
+    block each other, and a connection waits up to db_busy_timeout for another one's write lock instead of failing
+    with 'database is locked'. Every profiler shares one connection, config.db_con."""
+    con: sqlite3.Connection = sqlite3.connect(filename or db_file, timeout=db_busy_timeout)
+    con.execute(f'PRAGMA journal_mode = {db_journal_mode}')
+    con.execute('PRAGMA synchronous = NORMAL')  # With WAL, a power cut may lose the last commit but not corrupt
+    con.execute('PRAGMA cache_size = -65536')  # KiB, ie: 64 MiB of pages
+    con.execute(f'PRAGMA mmap_size = {256 * 2 ** 20}')
+    return con
+
+
+held_transactions: set[sqlite3.Connection] = set()  # Connections inside transaction()
+
+
+@contextmanager
+def transaction(con: sqlite3.Connection | None = None) -> Iterator[sqlite3.Connection]:
+    """Everything written inside is one transaction, committed at the end or rolled back on an error, so a failed
+    run leaves the tables as they were. BEGIN IMMEDIATE takes the write lock up front, waiting for another run to
+    finish its writes, instead of failing halfway with 'database is locked'. Used inside another, it joins it.
+
+    with transaction():
+        upsert_rows(...)
+        upsert_rows(...)"""
+    con = con or config.db_con
+
+    if con in held_transactions:
+        yield con
+        return
+
+    con.commit()  # Anything left pending, eg: ip cache entries
+    con.execute('BEGIN IMMEDIATE')
+    held_transactions.add(con)
+
+    try:
+        yield con
+    except BaseException:
+        con.rollback()
+        raise
+    else:
+        con.commit()
+    finally:
+        held_transactions.discard(con)
+
+
+class RunLease:
+    """A lease on a name in the run_leases table of db_file. Profilers hold one for the whole run, so a second run
+    started while the first is still going (eg: a slow night running into the next cron job) does not read the same
+    logs and checkpoints at the same time. A lease expires after ttl seconds, in case a run dies holding it."""
+
+    def __init__(self, con: sqlite3.Connection, name: str, ttl: int = run_lease_seconds):
+        self.con: sqlite3.Connection = con
+        self.name: str = name
+        self.ttl: int = ttl
+        self.holder: str = f'{gethostname()}:{getpid()}'
+
+    def acquire(self) -> bool:
+        # True if this run now holds the lease. Taken over when the last holder's lease has expired.
+        with transaction(self.con):
+            self.con.execute('''
+                INSERT INTO run_leases (name, holder, expires) VALUES (?, ?, ?)
+                ON CONFLICT (name) DO UPDATE SET holder = excluded.holder, expires = excluded.expires
+                WHERE run_leases.expires < ? OR run_leases.holder = excluded.holder''',
+                (self.name, self.holder, now() + self.ttl, now()))
+
+        return self.current() == self.holder
+
+    def current(self) -> str | None:
+        row: tuple[str] | None = self.con.execute(
+            'SELECT holder FROM run_leases WHERE name = ?', (self.name,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def release(self) -> None:
+        with transaction(self.con):
+            self.con.execute('DELETE FROM run_leases WHERE name = ? AND holder = ?', (self.name, self.holder))
+
+
+def hold_lease(*names: str) -> list[RunLease]:
+    # Call at the start of a run, with the name of each profiler it runs. Exits if another run holds any of them.
+    # They are released when this run exits.
+    leases: list[RunLease] = []
+
+    for name in names:
+        lease: RunLease = RunLease(config.db_con, name)
+
+        if not lease.acquire():
+            config.logger.warning(f'{name} is already running ({lease.current()}). Exiting.')
+            exit()  # The leases taken so far are released on exit
+
+        atexit.register(lease.release)
+        leases.append(lease)
+
+    return leases
+
+
+http_requests_key: tuple[str, ...] = ('vhost', 'ip', 'date', 'path', 'status')
+schema_migrations: list[Callable[[sqlite3.Connection], None]] = []  # Applied in order. user_version counts them.
+
+
+def migration(upgrade: Callable[[sqlite3.Connection], None]) -> Callable[[sqlite3.Connection], None]:
+    # Appends a schema upgrade. Never reorder or remove one, since a database only records how many it has had.
+    schema_migrations.append(upgrade)
+    return upgrade
+
+
+def migrate(con: sqlite3.Connection) -> None:
+    """Brings the schema of db_file up to date, in place. PRAGMA user_version holds the number of schema_migrations
+    already applied, and each missing one is applied in a transaction of its own, together with the new version, so a
+    failed upgrade leaves the database at the last good one. The version is read again inside each transaction, so
+    two runs starting at once do not apply the same migration twice."""
+    while True:
+        with transaction(con):
+            version: int = con.execute('PRAGMA user_version').fetchone()[0]
+
+            if version >= len(schema_migrations):
+                break
+
+            upgrade: Callable[[sqlite3.Connection], None] = schema_migrations[version]
+            upgrade(con)
+            con.execute(f'PRAGMA user_version = {version + 1}')
+
+        config.logger.info(f'Upgraded the schema of {db_file} to version {version + 1} ({upgrade.__name__})')
+
+
+def event_indexes(events: str, con: sqlite3.Connection) -> None:
+    # (date) for date ranges, eg: the plots, and (ip_id, date) for the history of an ip, unless the unique key
+    # already starts with those. With the (country) index of ip_geo, the two also serve queries by country and date.
+    key: list[str] = [row[2] for row in con.execute(f'PRAGMA index_info({events}_key)')]
+    con.execute(f'CREATE INDEX IF NOT EXISTS {events}_date ON {events} (date)')
+
+    if key[:2] != ['ip_id', 'date']:
+        con.execute(f'CREATE INDEX IF NOT EXISTS {events}_ip_date ON {events} (ip_id, date)')
+
+
+@migration
+def create_tables(con: sqlite3.Connection) -> None:
+    # The tables shared by every profiler. The event tables of each one are made by event_table(), since a vhost
+    # can be added at any time. Databases from before this keep their rows, as nothing is made twice.
+    con.execute('''
+        CREATE TABLE IF NOT EXISTS ip_cache (
+        ip TEXT PRIMARY KEY,
+        data TEXT,
+        fetched REAL,
+        last_used REAL
+        )''')
+    con.execute('CREATE TABLE IF NOT EXISTS api_usage (date TEXT PRIMARY KEY, lookups INTEGER)')
+    con.execute('''
+        CREATE TABLE IF NOT EXISTS ip_geo (
+        id INTEGER PRIMARY KEY,
+        ip TEXT UNIQUE NOT NULL,
+        city TEXT,
+        region TEXT,
+        country TEXT,
+        loc TEXT,
+        org TEXT,
+        postal TEXT,
+        timezone TEXT,
+        hostname TEXT,
+        anycast TEXT,
+        bogon REAL,
+        refreshed REAL
+        )''')
+    con.execute('''
+        CREATE TABLE IF NOT EXISTS http_requests (
+        vhost TEXT,
+        ip TEXT,
+        date TEXT,
+        path TEXT,
+        status INTEGER,
+        requests INTEGER,
+        bytes INTEGER
+        )''')
+    con.execute(
+        f'CREATE UNIQUE INDEX IF NOT EXISTS http_requests_key ON http_requests ({", ".join(http_requests_key)})'
+    )
+    con.execute('''
+        CREATE TABLE IF NOT EXISTS ssh_attempt_times (
+        ip_id INTEGER,
+        user TEXT,
+        date TEXT,
+        time TEXT
+        )''')
+    con.execute('CREATE INDEX IF NOT EXISTS ssh_attempt_times_attempt ON ssh_attempt_times (ip_id, user, date)')
+    con.execute('''
+        CREATE TABLE IF NOT EXISTS run_leases (
+        name TEXT PRIMARY KEY,
+        holder TEXT,
+        expires REAL
+        )''')
+
+
+@migration
+def add_date_indexes(con: sqlite3.Connection) -> None:
+    # Every table was read whole to pick out a week or a month. Event tables made from now on get these too.
+    con.execute('CREATE INDEX IF NOT EXISTS ip_geo_country ON ip_geo (country)')
+    con.execute('CREATE INDEX IF NOT EXISTS http_requests_date ON http_requests (date)')
+    con.execute('CREATE INDEX IF NOT EXISTS http_requests_ip_date ON http_requests (ip, date)')
+    con.execute('CREATE INDEX IF NOT EXISTS ssh_attempt_times_date ON ssh_attempt_times (date)')
+
+    tables: list[tuple[str]] = con.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name GLOB '*_events'"
+    ).fetchall()
+
+    for events, in tables:
+        event_indexes(events, con)
+
+
+# The profilers' own columns in the wide tables of before, which held the api data of the ip on every row. Every other
+# column but ip was api data. Vhost tables are named after their vhost, so they are told apart by their packets.
+wide_table_columns: dict[str, tuple[str, ...]] = {
+    'ssh_user': ('attempts', 'date', 'user', 'time', 'attempt_times'),
+    'accepted_ssh': ('user', 'time', 'date', 'on_lan'),
+    'f2b': ('date', 'time'),
+}
+wide_vhost_columns: tuple[str, ...] = ('packets', 'date', 'time', 'data')
+
+
+@migration
+def move_wide_tables(con: sqlite3.Connection) -> None:
+    """Moves each wide table into ip_geo and {table}_events (see event_table()), then drops it. Of the api data, the
+    latest row of each ip is kept. Rows that have the same key are all moved, and all but the first dropped when the
+    profiler makes its key. event_table() makes the view that takes the place of the table."""
+    tables: list[tuple[str]] = con.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT GLOB '*_events'"
+    ).fetchall()
+
+    for table, in tables:
+        stored: dict[str, str] = {row[1]: row[2] for row in con.execute(f'PRAGMA table_info({table})')}
+        columns: tuple[str, ...] = wide_table_columns.get(table, wide_vhost_columns if 'packets' in stored else ())
+
+        if 'ip' not in stored or not columns:
+            continue
+
+        kept: list[str] = [column for column in stored if column in columns]
+        geo: list[str] = [column for column in stored if column != 'ip' and column not in kept]
+        geo_stored: list[str] = table_columns('ip_geo', con)
+        events: str = f'{table}_events'
+        config.logger.info(f'Moving {table} into ip_geo and {events}')
+
+        for column in geo:
+            if column not in geo_stored:
+                con.execute(f'ALTER TABLE ip_geo ADD COLUMN {column}')
+
+        column_sql: str = ''.join(f',\n{column} {stored[column]}' for column in kept)
+        con.execute(f'CREATE TABLE IF NOT EXISTS {events} (\nip_id INTEGER REFERENCES ip_geo (id){column_sql}\n)')
+        geo_columns: str = ''.join(f', {column}' for column in geo)
+        con.execute(f'''
+            INSERT INTO ip_geo (ip{geo_columns})
+            SELECT ip{geo_columns} FROM {table}
+            WHERE rowid IN (SELECT max(rowid) FROM {table} WHERE ip IS NOT NULL GROUP BY ip)
+            ON CONFLICT (ip) DO NOTHING''')
+        con.execute(f'''
+            INSERT INTO {events} (ip_id{''.join(f', {column}' for column in kept)})
+            SELECT g.id{''.join(f', t.{column}' for column in kept)} FROM {table} t JOIN ip_geo g ON g.ip = t.ip''')
+        con.execute(f'DROP TABLE {table}')
+
+
+@migration
+def move_attempt_times(con: sqlite3.Connection) -> None:
+    # attempt_times was a json list on each ssh_user row, rewritten whole on every attempt. Its times become rows of
+    # ssh_attempt_times.
+    if 'attempt_times' in table_columns('ssh_user_events', con):
+        con.execute('''
+            INSERT INTO ssh_attempt_times (ip_id, user, date, time)
+            SELECT e.ip_id, e.user, e.date, j.value FROM ssh_user_events e, json_each(e.attempt_times) j
+            WHERE e.attempt_times IS NOT NULL''')
+        con.execute('ALTER TABLE ssh_user_events DROP COLUMN attempt_times')
+
+
+@migration
+def move_request_lines(con: sqlite3.Connection) -> None:
+    # data was a json list of every log line of the ip on each vhost row, rewritten whole on every request. The lines
+    # are rolled up per ip, day, path and status into http_requests.
+    tables: list[tuple[str]] = con.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name GLOB '*_events'"
+    ).fetchall()
+
+    for events, in tables:
+        if 'data' not in table_columns(events, con):
+            continue
+
+        vhost: str = events.removesuffix('_events')
+        config.logger.info(f'Moving the request lines of {events} into http_requests')
+        requests: dict[tuple[str, str, str, int], list[int]] = {}  # (ip, date, path, status) -> [requests, bytes]
+
+        for data, in con.execute(f'SELECT data FROM {events} WHERE data IS NOT NULL'):
+            for request in filter(None, map(parse_http_line, json.loads(data))):
+                rollup: list[int] = requests.setdefault(
+                    (request.ip, http_day_sql_date(request.day), request.path, request.status), [0, 0]
+                )
+                rollup[0] += 1
+                rollup[1] += request.bytes
+
+        rows: list[dict] = [
+            {'vhost': vhost, 'ip': ip, 'date': day, 'path': path, 'status': status, 'requests': count, 'bytes': size}
+            for (ip, day, path, status), (count, size) in requests.items()
+        ]
+        upsert_rows('http_requests', rows, key=http_requests_key, add=('requests', 'bytes'), con=con)
+        con.execute(f'ALTER TABLE {events} DROP COLUMN data')
+
+
 def handle_failed_requests(failed_requests: list) -> None:
     if len(failed_requests) > 0:
         pickle_file: str = f'{working_dir}/api_error.pickle'
@@ -173,7 +1295,7 @@ def handle_failed_requests(failed_requests: list) -> None:
             with open(pickle_file, 'wb') as pf:
                 pickle.dump([], pf)
 
-        logger.warning(f'Api Error occurred. Check {pickle_file}')
+        config.logger.warning(f'Api Error occurred. Check {pickle_file}')
 
         with open(pickle_file, 'rb') as pf:
             failure_data: list[dict] = pickle.load(pf)
@@ -183,38 +1305,156 @@ def handle_failed_requests(failed_requests: list) -> None:
         with open(pickle_file, 'wb') as pf:
             pickle.dump(failed_requests, pf)
     else:
-        logger.debug('failed_requests list is empty.')
+        config.logger.debug('failed_requests list is empty.')
 
 
-if trusted_ips_file and isfile(trusted_ips_file):
-    with open(trusted_ips_file, 'r') as f:
-        for line in f:
-            if line and not line.startswith('#'):
-                if '\n' in line:
-                    ip: str = line.replace('\n', '')
-                else:
-                    ip: str = line
-
-                if line:
-                    trusted_ips.append(ip)
-
-
-distro: str = os_release()['ID'].lower()
-match distro:
-    # find http logs based on distro
-    case 'ubuntu' | 'debian':
-        auth_file_dir: str = '/var/log/apache2/'  # http log files directory
-        ssh_log_files: list[str] = [f'/var/log/{file}' for file in listdir('/var/log/')
-                                    if file.startswith('auth.log')]
-
-    case 'centos' | 'rhel' | 'rocky' | 'almalinux' | 'fedora':
-        auth_file_dir: str = '/var/log/httpd/'  # http log files directory
-        ssh_log_files: list[str] = [f'/var/log/{file}' for file in listdir('/var/log/')
-                                    if file.startswith('secure')]
-    case _:
-        logging.warning(f'Unsupported OS -- {distro}')
-        raise NotImplementedError(f'{distro.title()} is not currently supported.'
-                                  f' Only supports Ubuntu, Debian, CentOs, RHEL, Rocky, AlmaLinux, and Fedora')
-
-http_log_files: list[str] = [f'{auth_file_dir}/{file}' for file in listdir(auth_file_dir)
-                             if file.startswith('access.log')]
+class Config:
+    """Everything in this module that has side effects or is slow to set up: the database connection, the api token,
+    trusted ips, logging, and the log file locations of this distro. Each one is resolved the first time it is used
+    and cached afterwards, so importing ip_profile_lib is cheap and needs none of those files to exist.
+
+    Scripts import these names from ip_profile_lib as before (from ip_profile_lib import db_con, logger). The module
+    looks them up on the shared config object when they are first imported."""
+
+    @cached_property
+    def logger(self) -> logging.Logger:
+        return MyLogger(
+            name='ip_profile',
+            to_file=logger_file,
+            to_console=True,
+            level=20
+        ).logger
+
+    @cached_property
+    def db_con(self) -> sqlite3.Connection:
+        con: sqlite3.Connection = connect()
+        migrate(con)
+        return con
+
+    @cached_property
+    def db_cursor(self) -> sqlite3.Cursor:
+        return self.db_con.cursor()
+
+    @cached_property
+    def ip_cache(self) -> IpCache:
+        return IpCache(self.db_con)
+
+    @cached_property
+    def ip_geo(self) -> 'IpGeo':
+        return IpGeo(self.db_con)
+
+    @cached_property
+    def log_manifest(self) -> LogManifest:
+        return LogManifest(self.db_con)
+
+    @cached_property
+    def parse_cache(self) -> ParseCache:
+        return ParseCache(self.db_con)
+
+    @cached_property
+    def my_token(self) -> str | None:
+        if not (api_token_file and isfile(api_token_file)):
+            return None
+
+        with open(api_token_file, 'r') as file:
+            my_tokens: list[str] = file.readlines()
+
+        my_token: str | None = None
+        for token in my_tokens:
+            # scroll through file for token. Ignore commented lines and pick the last token specified.
+            if not token.startswith('#'):
+                my_token = token
+
+        if my_token is None:
+            return None
+
+        if '?token=' not in my_token:
+            my_token: str = '?token=' + my_token
+
+        for whitespace in ['\n', ' ', '\t', '\r']:
+            my_token = my_token.replace(whitespace, '')  # replace with nothing. Same as deleting
+
+        return my_token
+
+    @cached_property
+    def lan_networks(self) -> IpNetworkSet:
+        return IpNetworkSet(LAN_networks)
+
+    @cached_property
+    def trusted_ips(self) -> IpNetworkSet:
+        trusted_ips: IpNetworkSet = IpNetworkSet(trusted_addresses + LAN_networks)
+
+        if trusted_ips_file and isfile(trusted_ips_file):
+            with open(trusted_ips_file, 'r') as f:
+                for line in f:
+                    ip: str = line.split('#')[0].strip()  # Ignore comments and blank lines
+
+                    if ip:
+                        trusted_ips.append(ip)
+
+        return trusted_ips
+
+    @cached_property
+    def api_connection_errors(self) -> tuple[type[Exception], ...]:
+        from urllib3.exceptions import ReadTimeoutError, DecodeError
+        from requests.exceptions import (
+            ReadTimeout, ContentDecodingError, HTTPError, RetryError, ConnectionError as RequestsConnectionError
+        )
+        return (TimeoutError, ReadTimeoutError, ReadTimeout, ApiError, DecodeError, ContentDecodingError,
+                HTTPError, RetryError, RequestsConnectionError)
+
+    @cached_property
+    def distro(self) -> str:
+        return os_release()['ID'].lower()
+
+    @cached_property
+    def auth_file_dir(self) -> str:
+        match self.distro:
+            # find http logs based on distro
+            case 'ubuntu' | 'debian':
+                return '/var/log/apache2/'  # http log files directory
+            case 'centos' | 'rhel' | 'rocky' | 'almalinux' | 'fedora':
+                return '/var/log/httpd/'  # http log files directory
+            case _:
+                raise self.unsupported_distro()
+
+    def unsupported_distro(self) -> NotImplementedError:
+        self.logger.warning(f'Unsupported OS -- {self.distro}')
+        return NotImplementedError(f'{self.distro.title()} is not currently supported.'
+                                   f' Only supports Ubuntu, Debian, CentOs, RHEL, Rocky, AlmaLinux, and Fedora')
+
+    @cached_property
+    def ssh_log_files(self) -> list[str]:
+        match self.distro:
+            # find ssh logs based on distro
+            case 'ubuntu' | 'debian':
+                prefix: str = 'auth.log'
+            case 'centos' | 'rhel' | 'rocky' | 'almalinux' | 'fedora':
+                prefix = 'secure'
+            case _:
+                raise self.unsupported_distro()
+
+        return [f'/var/log/{file}' for file in listdir('/var/log/') if file.startswith(prefix)]
+
+    @cached_property
+    def http_log_files(self) -> list[str]:
+        return [f'{self.auth_file_dir}/{file}' for file in listdir(self.auth_file_dir)
+                if file.startswith('access.log')]
+
+    @cached_property
+    def nextcloud_log_files(self) -> list[str]:
+        return [f'{self.auth_file_dir}/{file}' for file in listdir(self.auth_file_dir)
+                if file.startswith('nextcloud-access.log')]
+
+
+config: Config = Config()
+
+
+def __getattr__(name: str):
+    # Resolves the lazy names above on first import, eg: from ip_profile_lib import db_con
+    if name == 'ApiConnectionErrors':
+        return config.api_connection_errors
+    if not name.startswith('_') and isinstance(getattr(Config, name, None), cached_property):
+        return getattr(config, name)
+
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -1,160 +1,158 @@
 #!/nfs_share/matt_desktop/server_scripts/ip_profile/venv_311/bin/python3.11
-import pandas as pd
-import json
-from time import sleep
+import sqlite3
+from dataclasses import dataclass, field
+from ssh_log_parser import SshEvent, SshLogScan
+from log_files import LogCheckpoints, ssh_line_date
 from ip_profile_lib import (
-    ip_info, log_reader, ApiConnectionErrors, ssh_log_files, handle_failed_requests, convert_to_sql_type,
-    LAN_prefix, trusted_ips, my_token, ssh_log_date, db_con, sql_date, db_cursor, logger
+    EnrichmentPool, Pipeline, ssh_log_files, handle_failed_requests, ip_geo,
+    trusted_ips, ssh_log_date, ssh_sql_date, logger, finish_run, db_con,
+    log_checkpoints, is_later_ssh_line, logs_for_day, profile_day, event_table, upsert_rows,
+    transaction, hold_lease
 )
 
-# Try to get table from database if exists, or create new one
-try:
-    df_ssh: pd.DataFrame = pd.read_sql('select * from ssh_user', db_con)
-except pd.errors.DatabaseError as e:
-    error: str = e.args[0]
-
-    if 'no such table' in error:  # No such table found. Creating now.
-        logger.info('Creating table')
-        db_cursor.execute('''
-            CREATE TABLE ssh_user (
-            ip TEXT,
-            city TEXT,
-            region TEXT,
-            country TEXT,
-            loc TEXT,
-            org TEXT,
-            postal TEXT,
-            timezone TEXT,
-            attempts INTEGER,
-            date TEXT,
-            user TEXT,
-            hostname TEXT,
-            time TEXT,
-            anycast TEXT
-            )''')
-
-        df_ssh: pd.DataFrame = pd.read_sql('select * from ssh_user', db_con)  # Blank data frame from new table
-    else:
-        logger.critical('Failed to create table.')
-        logger.critical(e)
-        raise ConnectionError('Database connection failed')
-
-
-logger.info(' SSH USERNAMES '.center(40, "#"))
-failed_requests: list[dict[str, str]] = []
-logger.debug(ssh_log_files)
-
-trusted_ips_counter: int = 0
-
-# Go through the ssh auth files and find IP addresses that failed to connect.
-for ssh_log_file in ssh_log_files:
-    lines: list[str] = log_reader(ssh_log_file)
-
-    for line in lines:  # find the indexes of 'time', 'user', and 'ip' in the matched lines (to use with .split())
-        if ('Connection closed by invalid user' in line
-                and ssh_log_date in line
-                and LAN_prefix not in line):
-            line_elements: tuple[int, int, int] = (2, 10, 11)  # (2, -5, -4)
-        elif ('Connection closed by authenticating user' in line
-              and ssh_log_date in line
-              and LAN_prefix not in line):
-            line_elements: tuple[int, int, int] = (2, 10, 11)  # (2, -5, -4)
-        elif ('Disconnected from invalid user' in line
-              and ssh_log_date in line
-              and LAN_prefix not in line):
-            line_elements: tuple[int, int, int] = (2, 9, 10)  # (2, -5, -4)
-        elif ('Disconnected from authenticating user' in line
-              and ssh_log_date in line
-              and LAN_prefix not in line):
-            line_elements: tuple[int, int, int] = (2, 9, 10)
-        elif ('Disconnecting invalid user' in line
-              and ssh_log_date in line
-              and LAN_prefix not in line):
-            line_elements: tuple[int, int, int] = (2, 8, 9)
+ssh_user_columns: dict[str, str] = {
+    'attempts': 'INTEGER',
+    'date': 'TEXT',
+    'user': 'TEXT',
+    'time': 'TEXT',
+}
+# The ssh_user view shows the times of the attempts as the json list the table used to hold
+attempt_times_view: str = '''
+    , (SELECT json_group_array(t.time) FROM ssh_attempt_times t
+       WHERE t.ip_id = e.ip_id AND t.user = e.user AND t.date = e.date) AS attempt_times'''
+
+
+@dataclass(slots=True)
+class UserAttempts:
+    # The failed logins of one ip and username on one day
+    time: str  # Of the first attempt
+    attempts: int = 0
+    attempt_times: list[str] = field(default_factory=list)
+
+
+class FailedLogins:
+    """Counts failed ssh logins for each ip and username into the ssh_user table. It is the sink of a Pipeline of
+    'failed' events, after untrusted() and an enrichment stage. Call finish() once the pipeline has run.
+
+    The attempts are counted in a dict keyed by (ip, user, date), so each event is one lookup however busy the night
+    was. They become table rows once, in finish(). The time of each attempt is one row of ssh_attempt_times, which
+    is only appended to.
+
+    With incremental, the scan only read the lines added since the last run (through checkpoints), so the attempts
+    found are added to the stored ones. Otherwise whole days were read, and their counts and times replace the stored
+    ones, so reruns and backfills do not count anything twice."""
+
+    def __init__(self, pool: EnrichmentPool, incremental: bool = False):
+        self.pool: EnrichmentPool = pool  # Looks up new ips in the background while the logs are read
+        self.incremental: bool = incremental
+        self.failed_requests: list[dict[str, str]] = []
+        self.trusted_ips_counter: int = 0
+        self.attempts: dict[tuple[str, str, str], UserAttempts] = {}  # Only the attempts found this run
+
+        try:  # The api data of each ip is kept in ip_geo. The ssh_user view joins the two.
+            event_table('ssh_user', ssh_user_columns, key=('user', 'date'), details=attempt_times_view)
+        except sqlite3.DatabaseError as e:
+            logger.critical('Failed to create table.')
+            logger.critical(e)
+            raise ConnectionError('Database connection failed')
+
+    def untrusted(self, event: SshEvent) -> bool:
+        # Filter stage. Trusted ips will not be recorded, only counted.
+        if event.ip in trusted_ips:
+            self.trusted_ips_counter += 1
+            return False
+
+        return True
+
+    def __call__(self, event: SshEvent) -> None:
+        # Empty and whitespace usernames arrive as "' '" from the parser
+        key: tuple[str, str, str] = (event.ip, event.user, ssh_sql_date(event.day))
+        record: UserAttempts | None = self.attempts.get(key)
+
+        if record is None:  # a new attempt was made. Api data is added in one batch after the logs are read
+            record = self.attempts[key] = UserAttempts(event.time)
+
+        record.attempts += 1
+        record.attempt_times.append(event.time)  # Every time a connection was attempted
+
+    def rows(self) -> list[dict[str, str | int]]:
+        return [
+            {
+                'ip': ip,
+                'user': user,
+                'date': date,
+                'attempts': record.attempts,
+                'time': record.time,
+                'attempt_times': record.attempt_times,
+            }
+            for (ip, user, date), record in self.attempts.items()
+        ]
+
+    def finish(self) -> None:
+        logger.info(' SSH USERNAMES '.center(40, "#"))
+
+        # Wait for the api info about every new ip address, and merge it into the new rows
+        ip_data: dict[str, dict] = self.pool.results()
+
+        with transaction():  # The api data, counts and times of this run are written together, or not at all
+            rows, failed_entries = ip_geo.link(self.rows(), ip_data)
+            attempt_times: list[tuple] = [
+                (row['ip_id'], row['user'], row['date'], time) for row in rows for time in row.pop('attempt_times')
+            ]
+            upsert_rows(
+                'ssh_user_events', rows, key=('ip_id', 'user', 'date'), keep=('time',),
+                add=('attempts',) if self.incremental else ()
+            )
+            self.write_attempt_times(rows, attempt_times)
+
+        for failed_entry in failed_entries:
+            failed_entry['script'] = 'ssh_user'
+            self.failed_requests.append(failed_entry)
+            logger.error(f'Failed : {failed_entry}')
+
+        attempts_counter: int = sum(row['attempts'] for row in rows)
+        trusted_ips_counter: int = self.trusted_ips_counter
+
+        if attempts_counter == 0:
+            logger.info(f'No new connections found. Done. {trusted_ips_counter} trusted ips found.')
         else:
-            line_elements: None = None  # line is logging something unrelated. Ignore.
-
-        if line_elements:
-            # split the line and grab the related elements (based on its unique indexes)
-            x, y, z = line_elements
-            time: str = line.split()[x]
-            user: str = line.split()[y]
-            ip: str = line.split()[z]
-
-            """Some offenders will try to use a literal whitespace as the username, resulting in a whitespace where
-            the username should be. That is problematic for .split(). This if-statement offsets the problem. Also,
-            it is necessary to slice off the first 7 characters because dates will sometimes have a double white-
-            space too since the date format is '%b %e' -- eg: Jan  1."""
-
-            if '  ' in line[7:]:             # notice the double-whitespace in the quotes
-                user: str = "\' \'"          # A whitespace inside literal single-quotes will be entered into the database
-                ip: str = line.split()[z-1]  # 'ip' needs to be offset by -1 in .split(). And 'time' element is unaffected
-
-            if ip not in trusted_ips:  # Trusted ips will not be recorded
-                # Check to see how many prior attempts were made yesterday
-                ip_entries: int = df_ssh[
-                    (df_ssh.ip == ip) &
-                    (df_ssh.user == user) &
-                    (df_ssh.date == sql_date)
-                    ].ip.count()
-
-                if ip_entries == 0:  # a new attempt was made
-                    try:
-                        entry: dict[str, str | int] = ip_info(ip, my_token)  # Gather info about ip address from the api
-                        entry['user']: str = user  # Add user, date, attempts, and time to the dict
-                        entry['date']: str = sql_date
-                        entry['attempts']: int = 1
-                        entry['time']: str = time
-                        entry['attempt_times']: str = json.dumps([time])  # convert python list to sql text
-                        entry = convert_to_sql_type(entry)
-
-                        # Concat with old DataFrame
-                        df_entry: pd.DataFrame = pd.DataFrame([entry])  # Convert to DataFrame
-                        df_ssh: pd.DataFrame = pd.concat([df_ssh, df_entry], ignore_index=True)
-
-                    except ApiConnectionErrors as e:
-                        failed_entry: dict[str, str] = {
-                            'ip': ip,
-                            'user': user,
-                            'time': time,
-                            'date': sql_date,
-                            'line': line,
-                            'script': 'ssh_user',
-                        }
-                        failed_requests.append(failed_entry)
-                        logger.error(f'Failed : {failed_entry}')
-                        logger.error(e)
-                        logger.error(line)
-                        sleep(60)  # possible connection issue. Wait for resolution and continue
-                else:  # Attempt was already made. Increase 'attempt' counter by one in sql.
-                    df_index: int = df_ssh[
-                        (df_ssh.ip == ip) &
-                        (df_ssh.user == user) &
-                        (df_ssh.date == sql_date)
-                        ].index.item()  # Get the index for the match.
-
-                    # Increase the 'attempts' by one.
-                    df_ssh.at[df_index, 'attempts'] += 1
-                    # Create a list of all times a connection was attempted
-                    attempt_times: list[str] = json.loads(df_ssh.at[df_index, 'attempt_times'])
-                    attempt_times.append(time)
-                    # Convert list into string and insert into sql
-                    df_ssh.at[df_index, 'attempt_times'] = json.dumps(attempt_times)
-            else:
-                trusted_ips_counter += 1
-
-attempts_counter: int = df_ssh[df_ssh.date == sql_date].attempts.sum()
-
-if attempts_counter == 0:
-    logger.info(f'No new connections found. Done. {trusted_ips_counter} trusted ips found.')
-else:
-    df_ssh.to_sql(
-        name='ssh_user', 
-        con=db_con,
-        if_exists='replace',
-        index=False
+            num_unique_ips: int = len({row['ip_id'] for row in rows})
+            logger.info(f'{num_unique_ips} ips connected. {attempts_counter} attempts made. '
+                        f'{trusted_ips_counter} trusted ips')
+
+        handle_failed_requests(self.failed_requests)
+
+    def write_attempt_times(self, rows: list[dict], attempt_times: list[tuple]) -> None:
+        with transaction():
+            if not self.incremental:  # The whole day was read again, so its times replace the stored ones
+                db_con.executemany(
+                    'DELETE FROM ssh_attempt_times WHERE ip_id = ? AND user = ? AND date = ?',
+                    [(row['ip_id'], row['user'], row['date']) for row in rows]
+                )
+
+            db_con.executemany(
+                'INSERT INTO ssh_attempt_times (ip_id, user, date, time) VALUES (?, ?, ?, ?)', attempt_times
+            )
+
+
+if __name__ == '__main__':
+    hold_lease('ssh_user')
+    logger.debug(ssh_log_files)
+    enrichment_pool: EnrichmentPool = EnrichmentPool()
+    checkpoints: LogCheckpoints | None = log_checkpoints('ssh_user')
+    failed_logins: FailedLogins = FailedLogins(enrichment_pool, incremental=checkpoints is not None)
+
+    # Go through the ssh auth files and find IP addresses that failed to connect.
+    scan: SshLogScan = SshLogScan(
+        logs_for_day(ssh_log_files, ssh_line_date), ssh_log_date, checkpoints=checkpoints, hold=is_later_ssh_line,
+        day=profile_day
     )
-    num_unique_ips: int = df_ssh[df_ssh.date == sql_date].ip.nunique()
-    logger.info(f'{num_unique_ips} ips connected. {attempts_counter} attempts made. {trusted_ips_counter} trusted ips')
+    pipeline: Pipeline = Pipeline('ssh', scan.events())
+    pipeline.filter('failed', lambda event: event.kind == 'failed')
+    pipeline.filter('trusted', failed_logins.untrusted)
+    pipeline.tap('enrich', lambda event: enrichment_pool.submit(event.ip))
+    pipeline.run(failed_logins)
 
-handle_failed_requests(failed_requests)
+    failed_logins.finish()
+
+    finish_run(checkpoints, enrichment_pool, pipeline)
@@ -1,102 +1,98 @@
 #!/nfs_share/matt_desktop/server_scripts/ip_profile/venv_311/bin/python3.11
-import pandas as pd
-from sqlite3 import OperationalError
-from sys import argv
-from os import listdir
+import sqlite3
+from collections import Counter
+from ssh_log_parser import SshEvent, SshLogScan
+from log_files import ssh_line_date
 from ip_profile_lib import (
-    ip_info, log_reader, ApiConnectionErrors, db_con, LAN_prefix, LAN_region, sql_date, logger, db_cursor,
-    LAN_city, LAN_country, LAN_timezone, LAN_postal, my_token, ssh_log_date, handle_failed_requests
+    EnrichmentPool, Pipeline, lan_networks, LAN_region, ssh_sql_date, logger, ssh_log_files,
+    LAN_city, LAN_country, LAN_timezone, LAN_postal, ssh_log_date, handle_failed_requests, finish_run,
+    log_checkpoints, is_later_ssh_line, logs_for_day, profile_day, ip_geo, event_table, upsert_rows, transaction,
+    hold_lease
 )
 
-# Defaults
-log_files = [
-    f'/var/log/{file}'
-    for file in listdir('/var/log/')
-    if file.startswith('auth.log')
-]
-failed_requests = []
-script_name = argv[0]
-logger.info(' SSH ACCEPTED '.center(40, "#"))
-
-
-try:
-    df_accepted = pd.read_sql('select * from accepted_ssh', db_con)
-except pd.errors.DatabaseError as e:
-    error = (e.args[0]).lower()
-
-    if 'no such table' in error:
-        logger.warning('Creating database')
-        db_cursor.execute('''CREATE TABLE accepted_ssh (
-                        ip TEXT,
-                        user TEXT,
-                        time TEXT,
-                        date TEXT
-                        )''')
-        df_accepted = pd.read_sql('select * from accepted_ssh', db_con)
-    else:
-        logger.error(e)
-        logger.error('Failed to create table. Exiting')
-        exit()
-
-
-for log_file in log_files:
-    for line in log_reader(log_file):
-        if (
-                ('Accepted publickey' in line or 'Accepted password' in line)
-                and ssh_log_date in line
-        ):
-            time: str = line.split()[2]
-            user: str = line.split()[8]
-            ip: str = line.split()[10]
-            entry: dict = {'ip': ip, 'user': user, 'time': time, 'date': sql_date}
-
-            if ip.startswith(LAN_prefix):
-                entry['on_lan'] : bool = True
-                entry['city'] : str = LAN_city
-                entry['country'] : str = LAN_country
-                entry['postal'] : str = LAN_postal
-                entry['region'] : str = LAN_region
-                entry['timezone'] : str = LAN_timezone
-            else:
-                entry['on_lan'] = False
-
-                try:
-                    api_info = ip_info(ip, my_token)
-                    entry.update(api_info)
-                except ApiConnectionErrors as e:
-                    logger.error(e)
-                    logger.error(line)
-                    failed_request = {
-                            'ip': ip, 'user': user, 
-                            'time': time, 'date': sql_date, 
-                            'line': line, 'script': 'ssh_accepted'
-                            }
-                    failed_requests.append(failed_request)
-                    continue
-
-            df_entry = pd.DataFrame([entry])
-            df_accepted = pd.concat(objs=[df_accepted, df_entry], ignore_index=True)
-
-
-df_accepted.to_sql(
-    name='accepted_ssh',
-    con=db_con,
-    if_exists='replace',
-    index=False
-)
-
-df = df_accepted[df_accepted.date == sql_date]
-
-unique_users = df.user.unique().tolist()
-users_str = 'Usernames found:'
-
-for user in unique_users:
-    num_uses = df[df.user == user].ip.count()
-    users_str += f' {user} ({num_uses}),'
-
-if len(unique_users) == 0:
-    logger.info('No usernames found.')
-else:
-    logger.info(users_str[:-1])
-
-handle_failed_requests(failed_requests)
+accepted_ssh_columns = {
+    'user': 'TEXT',
+    'time': 'TEXT',
+    'date': 'TEXT',
+    'on_lan': 'INTEGER',
+}
+
+
+class AcceptedLogins:
+    """Records every accepted ssh login into accepted_ssh_events, which is read through the accepted_ssh view. It is
+    the sink of a Pipeline of 'accepted' events, after an enrichment stage for logins from outside the LAN. Call
+    finish() once the pipeline has run."""
+
+    def __init__(self, pool):
+        self.pool = pool  # Looks up new ips in the background while the logs are read
+        self.failed_requests = []
+        self.entries = []  # Logins found in the logs. Logins from outside the LAN get api data once the logs are read.
+
+        try:  # A login is its ip, user and second, so reading a day again (eg: a backfill) does not add it twice
+            event_table('accepted_ssh', accepted_ssh_columns, key=('user', 'date', 'time'))
+        except sqlite3.DatabaseError as e:
+            logger.error(e)
+            logger.error('Failed to create table. Exiting')
+            exit()
+
+    def __call__(self, event: SshEvent) -> None:
+        ip = event.ip
+        entry: dict = {
+            'ip': ip, 'user': event.user, 'time': event.time, 'date': ssh_sql_date(event.day),
+            'on_lan': ip in lan_networks
+        }
+        self.entries.append(entry)
+
+    def finish(self) -> None:
+        logger.info(' SSH ACCEPTED '.center(40, "#"))
+        ip_data = dict(self.pool.results())
+        lan_data = {
+            'city': LAN_city, 'country': LAN_country, 'postal': LAN_postal, 'region': LAN_region,
+            'timezone': LAN_timezone
+        }
+
+        for entry in self.entries:
+            if entry['on_lan']:  # Not looked up
+                ip_data[entry['ip']] = lan_data
+
+        with transaction():  # The api data and logins of this run are written together, or not at all
+            rows, failed_entries = ip_geo.link(self.entries, ip_data)
+            upsert_rows('accepted_ssh_events', rows, key=('ip_id', 'user', 'date', 'time'))
+
+        for failed_entry in failed_entries:
+            failed_request = {**failed_entry, 'script': 'ssh_accepted'}
+            self.failed_requests.append(failed_request)
+            logger.error(f'Failed : {failed_request}')
+
+        unique_users = Counter(row['user'] for row in rows)
+        users_str = 'Usernames found:'
+
+        for user, num_uses in unique_users.items():
+            users_str += f' {user} ({num_uses}),'
+
+        if len(unique_users) == 0:
+            logger.info('No usernames found.')
+        else:
+            logger.info(users_str[:-1])
+
+        handle_failed_requests(self.failed_requests)
+
+
+if __name__ == '__main__':
+    hold_lease('accepted_ssh')
+    enrichment_pool = EnrichmentPool()
+    accepted_logins = AcceptedLogins(enrichment_pool)
+
+    checkpoints = log_checkpoints('accepted_ssh')
+    scan = SshLogScan(
+        logs_for_day(ssh_log_files, ssh_line_date), ssh_log_date, checkpoints=checkpoints, hold=is_later_ssh_line,
+        day=profile_day
+    )
+    pipeline = Pipeline('ssh_accepted', scan.events())
+    pipeline.filter('accepted', lambda event: event.kind == 'accepted')
+    pipeline.tap('enrich', lambda event: event.ip in lan_networks or enrichment_pool.submit(event.ip))
+    pipeline.run(accepted_logins)
+
+    accepted_logins.finish()
+
+    finish_run(checkpoints, enrichment_pool, pipeline)
@@ -0,0 +1,35 @@
+#!/nfs_share/matt_desktop/server_scripts/ip_profile/venv_311/bin/python3.11
+# Runs ip_profile_ssh and ip_profile_ssh_accepted from a single read of the ssh logs. Schedule this instead of the two
+# scripts to read and decompress every auth.log / secure file once a night instead of twice.
+from ssh_log_parser import SshLogScan
+from log_files import ssh_line_date
+from ip_profile_ssh import FailedLogins
+from ip_profile_ssh_accepted import AcceptedLogins
+from ip_profile_lib import (
+    EnrichmentPool, Pipeline, lan_networks, ssh_log_files, ssh_log_date, finish_run, logger, log_checkpoints,
+    is_later_ssh_line, logs_for_day, profile_day, hold_lease
+)
+
+hold_lease('ssh_user', 'accepted_ssh')  # Same tables as ip_profile_ssh and ip_profile_ssh_accepted, so never at once
+logger.debug(ssh_log_files)
+enrichment_pool = EnrichmentPool()  # Shared, so an ip seen by both consumers is only looked up once
+# Checkpoints of their own, since this scan reads the logs for both profilers
+checkpoints = log_checkpoints('ssh_scan')
+failed_logins = FailedLogins(enrichment_pool, incremental=checkpoints is not None)
+accepted_logins = AcceptedLogins(enrichment_pool)
+scan = SshLogScan(
+    logs_for_day(ssh_log_files, ssh_line_date), ssh_log_date, checkpoints=checkpoints, hold=is_later_ssh_line,
+    day=profile_day
+)
+scan.register('failed', failed_logins)
+scan.register('accepted', accepted_logins)
+
+pipeline = Pipeline('ssh_scan', scan.events())
+pipeline.filter('trusted', lambda event: event.kind == 'accepted' or failed_logins.untrusted(event))
+pipeline.tap('enrich', lambda event: event.ip in lan_networks or enrichment_pool.submit(event.ip))
+pipeline.run(scan.dispatch)  # Each event goes to the consumer of its kind
+
+failed_logins.finish()
+accepted_logins.finish()
+
+finish_run(checkpoints, enrichment_pool, pipeline)
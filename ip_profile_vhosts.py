@@ -1,125 +1,152 @@
 #!/nfs_share/matt_desktop/server_scripts/ip_profile/venv_311/bin/python3.11
-from sys import argv
-import json
-import pandas as pd
-from time import sleep
+import sqlite3
+from dataclasses import dataclass
 from os.path import isfile
+from http_log_parser import VhostDispatcher, HttpRollup
+from log_files import http_line_date
 from ip_profile_lib import (
-    ip_info, log_reader, trusted_ips, sql_date, http_log_date, LAN_prefix, http_log_files,
-    logger, db_cursor, vhosts, my_token, ApiConnectionErrors, handle_failed_requests, db_con
+    EnrichmentPool, Pipeline, trusted_ips, http_day_sql_date, http_log_date, http_log_files,
+    logger, vhosts, handle_failed_requests, ip_geo, finish_run, event_table,
+    log_checkpoints, is_later_http_line, logs_for_day, profile_day, upsert_rows,
+    transaction, hold_lease, http_requests_key
 )
 
-
-script_name = argv[0]
-failed_requests = []
-http_log_files = [file for file in http_log_files if isfile(file)]
-
-for vhost in vhosts:
-    # Try to get table from database (if exists)
-    try:
-        df = pd.read_sql(f'select * from {vhost}', db_con)
-        error = None
-    except pd.errors.DatabaseError as e:
-        error = (e.args[0]).lower()
-        if 'no such table' in error:  # No such table found. Creating now.
-            logger.info('Creating table')
-            db_cursor.execute(f'''
-                CREATE TABLE {vhost} (
-                ip TEXT,
-                city TEXT,
-                region TEXT,
-                country TEXT,
-                org TEXT,
-                packets INTEGER,
-                date TEXT,
-                hostname TEXT,
-                time TEXT,
-                data TEXT,
-                loc TEXT,
-                postal TEXT,
-                timezone TEXT,
-                bogon REAL
-                )''')
-
-            df = pd.read_sql(f'select * from {vhost}', db_con)  # Blank data frame from new table
-        else:
+vhost_columns: dict[str, str] = {
+    'packets': 'INTEGER',
+    'date': 'TEXT',
+    'time': 'TEXT',
+}
+
+
+def request_rows(vhost: str, requests: dict) -> list[dict]:
+    # http_requests rows of a rollup, (ip, date, path, status) -> [requests, bytes]
+    return [
+        {'vhost': vhost, 'ip': ip, 'date': date, 'path': path, 'status': status, 'requests': count, 'bytes': size}
+        for (ip, date, path, status), (count, size) in requests.items()
+    ]
+
+
+@dataclass(slots=True)
+class IpVisits:
+    # The requests of one ip to one vhost on one day
+    time: str  # Of the first request
+    packets: int = 0
+
+
+class VhostVisits:
+    """Counts the requests each ip made to one vhost, into {vhost}_events, which is read through a view named after
+    the vhost (see ip_profile_lib.event_table()). The requests are also rolled up per ip, day, path and status into
+    the http_requests table, for reports on paths and status codes. Register it with a VhostDispatcher that is the
+    sink of a Pipeline (see vhost_pipeline()), and call finish() once the pipeline has run. Both are counted in dicts
+    during the run, and written as rows once, in finish().
+
+    With incremental, the logs were read through checkpoints, so the counts found are added to the stored ones.
+    Otherwise whole days were read, and their counts replace the stored ones."""
+
+    def __init__(self, vhost, pool, incremental=False):
+        self.vhost = vhost
+        self.pool = pool  # Looks up new ips in the background while the logs are read
+        self.incremental = incremental  # Only the lines added since the last run were read
+        self.failed_requests = []
+        self.counter = 0
+        self.visits: dict[tuple[str, str], IpVisits] = {}  # (ip, date). Only the visits found this run
+        self.requests = {}  # (ip, date, path, status) -> [requests, bytes]
+
+        try:  # The api data of each ip is kept in ip_geo. A view named after the vhost joins the two.
+            self.table = event_table(vhost, vhost_columns, key=('date',))
+        except sqlite3.DatabaseError as e:
             logger.error('Failed to create table.')
             logger.error(e)
             logger.error('Exiting.')
             exit()
 
-    # Begin reading through logs and finding the data
-    counter = 0
+    def __call__(self, rollup: HttpRollup):
+        ip = rollup.ip
+        date = http_day_sql_date(rollup.day)
+        self.counter += rollup.requests
+        visits = self.visits.get((ip, date))
+
+        if visits is None:  # A new connection was found. Api data is added in one batch at the end.
+            visits = self.visits[(ip, date)] = IpVisits(rollup.time)
+            logger.debug(f'{ip} {date} {visits.time}')
+        else:  # Rollups of one ip and day come from each path, and from each chunk of each file
+            visits.time = min(visits.time, rollup.time)
+
+        visits.packets += rollup.requests  # Increase packet counter
+
+        requests = self.requests.setdefault((ip, date, rollup.path, rollup.status), [0, 0])
+        requests[0] += rollup.requests
+        requests[1] += rollup.bytes
+
+    def rows(self) -> list[dict]:
+        return [
+            {'ip': ip, 'packets': visits.packets, 'date': date, 'time': visits.time}
+            for (ip, date), visits in self.visits.items()
+        ]
+
+    def finish(self):
+        # Wait for the api info about every new ip address, and merge it into the new rows
+        ip_data = self.pool.results()
+
+        with transaction():  # The api data and counts of this run are written together, or not at all
+            rows, failed_entries = ip_geo.link(self.rows(), ip_data)
+            upsert_rows(
+                self.table, rows, key=('ip_id', 'date'), keep=('time',),
+                add=('packets',) if self.incremental else ()
+            )
+            upsert_rows(
+                'http_requests', request_rows(self.vhost, self.requests), key=http_requests_key,
+                add=('requests', 'bytes') if self.incremental else ()
+            )
+
+        for failed_entry in failed_entries:
+            failed_entry['script'] = 'vhost'
+            self.failed_requests.append(failed_entry)
+            logger.error(f'Failed : {failed_entry}')
+
+        logger.info(f' {self.vhost.upper()} '.center(40, "#"))
+
+        if self.counter > 0:
+            num_ip_addresses = len({row['ip_id'] for row in rows})
+
+            logger.info(f'{self.counter} packets transmitted. {num_ip_addresses} addresses connected.')
+        else:
+            logger.info('No new connections found.')
 
-    for log_file in http_log_files:
-        try:
-            lines = log_reader(log_file)  # Generator based on the lines of the log file
-        except FileNotFoundError as e:
-            logger.error(e)
-            continue
-
-        for line in lines:
-            ip = line.split()[0]
-            time = line.split()[3].split('/')[-1][5:]
-
-            if (
-                    http_log_date in line
-                    and vhost in line
-                    and LAN_prefix not in line
-                    and ip not in trusted_ips
-            ):
-                counter += 1
-                # Check to see if ip is already in database for yesterday
-                ip_entries = df[
-                    (df.ip == ip) &
-                    (df.date == sql_date)
-                    ].ip.count()
-
-                if ip_entries == 0:  # A new connection was found
-                    try:
-                        entry = ip_info(ip, my_token)
-                        entry['packets'] = 1
-                        entry['date'] = sql_date
-                        entry['time'] = time
-                        entry['data'] = json.dumps([line])  # Python list stored in DB as a string
-
-                        logger.debug(entry)
-                        df_entry = pd.DataFrame([entry])
-                        df = pd.concat(objs=[df, df_entry], ignore_index=True)
-
-                    except ApiConnectionErrors as error:
-                        failed_request = {
-                            'ip': ip, 'time': time, 'date': sql_date, 'line': line, 'script': 'vhost'
-                        }
-                        failed_requests.append(failed_request)
-                        logger.error(line)
-                        logger.error(error)
-                        sleep(60)
-
-                else:  # Add to already existing connection
-                    df_index = df[
-                            (df.ip == ip) &
-                            (df.date == sql_date)
-                        ].index.item()
-
-                    data = json.loads(df.at[df_index, 'data'])  # Take DB entry and convert to python list
-                    data.append(line)                           # Add new packet data from http log to list
-                    df.at[df_index, 'data'] = json.dumps(data)  # Convert data back to str and insert in DB
-                    df.at[df_index, 'packets'] += 1             # Increase packet counter
-
-    logger.info(f' {vhost.upper()} '.center(40, "#"))
-
-    if counter > 0:
-        num_ip_addresses = df[df.date == sql_date].ip.nunique()
-
-        logger.info(f'{counter} packets transmitted. {num_ip_addresses} addresses connected.')
-        df.to_sql(
-            name=vhost,
-            con=db_con,
-            if_exists='replace',
-            index=False
-        )
-    else:
-        logger.info('No new connections found.')
-
-handle_failed_requests(failed_requests)
+        handle_failed_requests(self.failed_requests)
+
+
+def vhost_pipeline(name, dispatcher, files, pool, vhost=None, date_range=None) -> Pipeline:
+    # The HttpRollups of files, less the trusted ips, with their ips sent to the enrichment pool.
+    # With date_range (first, last as 'YYYY-MM-DD'), rollups of other days are dropped too.
+    pipeline = Pipeline(name, dispatcher.rollups(files, vhost))
+
+    if date_range:
+        first, last = date_range
+        pipeline.filter('date', lambda rollup: first <= http_day_sql_date(rollup.day) <= last)
+
+    pipeline.filter('trusted', lambda rollup: rollup.ip not in trusted_ips)
+    pipeline.tap('enrich', lambda rollup: pool.submit(rollup.ip))
+    return pipeline
+
+
+if __name__ == '__main__':
+    hold_lease('vhosts')
+    enrichment_pool = EnrichmentPool()
+    # One pass over the logs. The requests of each line go to the vhost it belongs to.
+    checkpoints = log_checkpoints('vhosts')
+    dispatcher = VhostDispatcher(http_log_date, checkpoints=checkpoints, hold=is_later_http_line, day=profile_day)
+    visits = [VhostVisits(vhost, enrichment_pool, incremental=checkpoints is not None) for vhost in vhosts]
+
+    for vhost_visits in visits:
+        dispatcher.register(vhost_visits.vhost, vhost_visits)
+
+    # Rotated logs without lines from the day being profiled are skipped
+    files = logs_for_day((file for file in http_log_files if isfile(file)), http_line_date)
+    pipeline = vhost_pipeline('vhosts', dispatcher, files, enrichment_pool)
+    pipeline.run(dispatcher.dispatch)
+
+    for vhost_visits in visits:
+        vhost_visits.finish()
+
+    finish_run(checkpoints, enrichment_pool, pipeline)
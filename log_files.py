@@ -0,0 +1,544 @@
+#!/nfs_share/matt_desktop/server_scripts/ip_profile/venv_311/bin/python3.11
+import gzip
+import marshal
+import re
+import sqlite3
+import zlib
+from concurrent.futures import ProcessPoolExecutor, Future
+from datetime import date, datetime
+from glob import glob
+from mmap import mmap, ACCESS_READ
+from os import stat
+from os.path import getmtime, getsize
+from time import time as now
+from typing import Callable, Generator, Iterable, Iterator
+
+month_numbers: dict[str, int] = {
+    month: number for number, month in enumerate(
+        ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'], 1
+    )
+}
+
+# auth.log.1, auth.log.2.gz, secure-20240101, secure-20240101.gz ...
+rotation_suffix: re.Pattern = re.compile(r'(\.\d+|-\d{8})?(\.gz)?$')
+
+
+def live_path(filename: str) -> str:
+    # The file that logrotate rotated filename out of. auth.log.2.gz -> auth.log
+    return rotation_suffix.sub('', filename)
+
+
+def is_live(filename: str) -> bool:
+    return live_path(filename) == filename
+
+
+def ssh_line_date(line: str, year: int) -> date | None:
+    # 'Oct 17 01:00:00 host sshd...' has no year, so it is taken from year. Newer distros log '2024-10-17T01:00:00'
+    try:
+        if line[:4].isdigit():
+            return date.fromisoformat(line[:10])
+
+        month, day = line[:6].split()
+        return date(year, month_numbers[month], int(day))
+    except (ValueError, KeyError):
+        return None
+
+
+def http_line_date(line: str, year: int | None = None) -> date | None:
+    # '1.2.3.4 - - [17/Oct/2024:10:00:00 +0000] "GET / ...'
+    start: int = line.find('[') + 1
+
+    try:
+        day, month, line_year = line[start:start + 11].split('/')
+        return date(int(line_year), month_numbers[month], int(day))
+    except (ValueError, KeyError):
+        return None
+
+
+def dated(line: str, line_date: Callable[[str, int], date | None], modified: date) -> date | None:
+    # Syslog lines have no year. The file was last written on modified, so no line is later than that.
+    line_day: date | None = line_date(line, modified.year)
+
+    if line_day and line_day > modified:
+        line_day = line_date(line, modified.year - 1)
+
+    return line_day
+
+
+def open_log(filename: str):
+    # Binary file handle, so byte offsets can be tracked and seeked to
+    return gzip.open(filename, 'rb') if filename.endswith('.gz') else open(filename, 'rb')
+
+
+def file_chunks(filename: str, chunk_size: int) -> list[tuple[int, int | None]]:
+    # Byte ranges (start, end) to split a plain log into. A .gz file can only be read from the start, so it is one chunk
+    size: int = 0 if filename.endswith('.gz') else getsize(filename)
+
+    if size <= chunk_size:
+        return [(0, None)]
+
+    return [(start, min(start + chunk_size, size)) for start in range(0, size, chunk_size)]
+
+
+def read_chunk(filename: str, start: int = 0, end: int | None = None) -> Iterator[str]:
+    # The lines that start between the byte offsets start and end. A line crossing start belongs to the chunk before.
+    with open_log(filename) as fh:
+        if start:
+            fh.seek(start - 1)
+            fh.readline()
+
+        position: int = fh.tell()
+
+        for raw_line in fh:
+            if end is not None and position >= end:
+                break
+
+            yield raw_line.decode()
+            position += len(raw_line)
+
+
+def day_range(mm: mmap, day: date, line_date: Callable[[str, int], date | None], modified: date) -> tuple[int, int]:
+    """The byte offsets where the lines of day start and end in a time ordered log, found by bisecting on the dates of
+    the lines. Falls back to the whole file when a probed line has no date."""
+    def first_line(after: bool) -> int | None:
+        # Offset of the first line dated on day or later (after: later than day)
+        low: int = 0
+        high: int = len(mm)
+
+        while low < high:
+            middle: int = (low + high) // 2
+            line_start: int = mm.rfind(b'\n', 0, middle) + 1  # Back to the start of the line middle falls in
+            line_end: int = mm.find(b'\n', middle) + 1 or len(mm)
+            line_day: date | None = dated(mm[line_start:line_end].decode(errors='replace'), line_date, modified)
+
+            if line_day is None:
+                return None
+
+            if line_day < day or (after and line_day == day):
+                low = line_end
+            else:
+                high = line_start
+
+        return low
+
+    start: int | None = first_line(after=False)
+    end: int | None = first_line(after=True)
+
+    if start is None or end is None:
+        return 0, len(mm)
+
+    return start, end
+
+
+def grep_log(filename: str, needles: Iterable[str | None], start: int = 0, end: int | None = None,
+             day: date | None = None, line_date: Callable[[str, int], date | None] | None = None,
+             block_size: int = 16 * 2 ** 20) -> Iterator[str]:
+    """Yields the lines of filename that contain every one of needles, like read_chunk() but searching the raw bytes.
+    Plain files are memory mapped and searched for the first needle with mmap.find(), so the lines in between are
+    never split up or decoded. Only the lines that match are copied out and decoded. .gz files are decompressed in
+    blocks of block_size and searched the same way.
+
+    Put the rarest needle first, eg: the date for a log that covers many days. Given the day of the lines wanted and
+    line_date (eg: ssh_line_date), only the part of a plain file between the first and last line of day is searched.
+    See day_range()."""
+    encoded: list[bytes] = [needle.encode() for needle in needles if needle]
+
+    if not encoded:
+        yield from read_chunk(filename, start, end)
+    elif filename.endswith('.gz'):
+        with gzip.open(filename, 'rb') as fh:
+            tail: bytes = b''
+
+            while block := fh.read(block_size):
+                buffer: bytes = tail + block
+                cut: int = buffer.rfind(b'\n') + 1  # The last line may continue in the next block
+                yield from grep_buffer(buffer, encoded, 0, cut)
+                tail = buffer[cut:]
+
+            yield from grep_buffer(tail, encoded, 0, len(tail))
+    elif getsize(filename):  # Empty files cannot be mapped
+        with open(filename, 'rb') as fh, mmap(fh.fileno(), 0, access=ACCESS_READ) as mm:
+            # Same chunk boundaries as read_chunk(): the lines that start between start and end
+            if day and line_date:
+                day_start, day_end = day_range(mm, day, line_date, datetime.fromtimestamp(getmtime(filename)).date())
+                start = max(start, day_start)
+                end = day_end if end is None else min(end, day_end)
+
+                if start >= end:
+                    return
+
+            position: int = mm.find(b'\n', start - 1) + 1 if start else 0
+            stop: int = len(mm) if end is None else mm.find(b'\n', end - 1) + 1 or len(mm)
+
+            if position or not start:  # Otherwise no line starts after start
+                yield from grep_buffer(mm, encoded, position, stop)
+
+
+def grep_buffer(buffer, needles: list[bytes], position: int, stop: int) -> Iterator[str]:
+    # buffer is bytes or an mmap, and position is the start of a line
+    first, others = needles[0], needles[1:]
+
+    while (hit := buffer.find(first, position, stop)) != -1:
+        line_start: int = buffer.rfind(b'\n', position, hit) + 1 or position
+        line_end: int = buffer.find(b'\n', hit, stop) + 1 or stop
+        line: bytes = buffer[line_start:line_end]
+
+        if all(needle in line for needle in others):
+            yield line.decode()
+
+        position = line_end
+
+
+def map_log_chunks(files: list[str], function: Callable, args: tuple, workers: int, chunk_size: int,
+                   local_files: Iterable[str] = (), read_local: Callable[[str], Iterable] | None = None) -> Iterator:
+    """Yields what function(filename, start, end, *args) returns for each chunk of files, worked out by a pool of
+    processes. function must be importable by name (a module level function), and should return a list. Results come
+    in file and chunk order, whichever worker finishes first, so the output is the same as reading the files one by one.
+
+    Files in local_files are read in this process by read_local(filename) instead, in their place in the order. Use it
+    for files read through LogCheckpoints, which track the offset as the lines are read."""
+    local_files: set[str] = set(local_files)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures: dict[str, list[Future]] = {
+            filename: [
+                executor.submit(function, filename, start, end, *args)
+                for start, end in file_chunks(filename, chunk_size)
+            ]
+            for filename in files if filename not in local_files
+        }
+
+        for filename in files:
+            if filename in futures:
+                for future in futures[filename]:
+                    yield from future.result()
+            else:
+                yield from read_local(filename)
+
+
+class LogCheckpoints:
+    """Remembers how far each live log file has been read (its inode and byte offset), so the next run only reads the
+    lines added since. Stored in the log_checkpoints table, per name, so independent profilers keep separate places.
+
+    When the inode of a live file changes, logrotate has moved it. The rest of the old file is read from its rotated
+    successor (auth.log.1, or auth.log.1.gz when it was compressed right away) before the new file is read from the
+    start. When hold() stops reading inside the rotated copy, eg: logrotate ran after midnight, the checkpoint stays on
+    the old file, and the new one is only started once the rest of it has been read.
+
+    A file that was truncated in place (copytruncate) is read from the start too. It is found by the bytes just before
+    the checkpoint, which are saved with it: once the file is rewritten, they no longer match, even when the new data
+    has already grown past the old offset.
+
+    Rotated files are not checkpointed. On the first run, when there is no checkpoint yet, every file is read in full
+    like before. Checkpoints only move forward on commit(), which should be called once the results are saved."""
+
+    def __init__(self, con: sqlite3.Connection, name: str):
+        self.con: sqlite3.Connection = con
+        self.name: str = name
+        self.pending: dict[str, tuple[int, int]] = {}  # path -> (inode, offset) reached during this run
+
+        self.con.execute('''
+            CREATE TABLE IF NOT EXISTS log_checkpoints (
+            name TEXT,
+            path TEXT,
+            inode INTEGER,
+            size INTEGER,
+            offset INTEGER,
+            updated REAL,
+            fingerprint BLOB,
+            PRIMARY KEY (name, path)
+            )''')
+        self.con.commit()
+        self.saved: dict[str, tuple[int, int, bytes]] = {  # path -> (inode, offset, fingerprint)
+            path: (inode, offset, mark) for path, inode, offset, mark in self.con.execute(
+                'SELECT path, inode, offset, fingerprint FROM log_checkpoints WHERE name = ?', (name,)
+            )
+        }
+
+    def select(self, files: Iterable[str]) -> list[str]:
+        # Rotated files only need reading when their live file has no checkpoint yet. Otherwise read() follows the
+        # rotation from the live file.
+        files: list[str] = list(files)
+        return [file for file in files if is_live(file) or live_path(file) not in self.saved]
+
+    def read(self, path: str, hold: Callable[[str], bool] | None = None) -> Iterator[str]:
+        """Yield the lines of the live file path that were not read yet. Reading stops before the first line for which
+        hold(line) is true. The checkpoint stays in front of that line, so it is read again next run. Use it to leave
+        lines newer than the day being profiled for the next run."""
+        inode: int = stat(path).st_ino
+        offset: int = 0
+
+        if path in self.saved:
+            saved_inode, saved_offset, saved_fingerprint = self.saved[path]
+
+            if inode != saved_inode:  # Rotated. Finish the old file first.
+                rotated: str | None = self.find_rotated(path, saved_inode)
+
+                if rotated:
+                    self.pending[path] = (saved_inode, saved_offset)
+
+                    if not (yield from self._read_from(rotated, saved_offset, hold, track=path)):
+                        return  # Held inside the rotated copy. The checkpoint stays on it until it is read to the end.
+                else:
+                    from ip_profile_lib import logger
+                    logger.warning(f'Could not find the rotated copy of {path}. Some lines may be skipped.')
+            elif stat(path).st_size >= saved_offset and fingerprint(path, saved_offset) == saved_fingerprint:
+                offset = saved_offset
+            # else: truncated in place (copytruncate). Start over.
+
+        self.pending[path] = (inode, offset)
+        yield from self._read_from(path, offset, hold, track=path)
+
+    def _read_from(self, filename: str, offset: int, hold: Callable[[str], bool] | None,
+                   track: str | None = None) -> Generator[str, None, bool]:
+        # Returns True once the end of the file is reached, False when hold() stopped it
+        with open_log(filename) as fh:
+            fh.seek(offset)  # For .gz files this is an offset into the decompressed data
+
+            for raw_line in fh:
+                line: str = raw_line.decode()
+
+                if hold and hold(line):
+                    return False
+
+                yield line
+                offset += len(raw_line)
+
+                if track:  # Only advanced once the caller asks for the next line, ie: this one was processed
+                    self.pending[track] = (self.pending[track][0], offset)
+
+        return True
+
+    @staticmethod
+    def find_rotated(path: str, inode: int) -> str | None:
+        candidates: list[str] = [file for file in glob(f'{path}.1*') + glob(f'{path}-*') if live_path(file) == path]
+
+        for candidate in candidates:  # Rotated without compression. Still the same inode.
+            if stat(candidate).st_ino == inode:
+                return candidate
+
+        if candidates:  # Compressed on rotation, so the inode changed. Use the most recent rotation.
+            return max(candidates, key=getmtime)
+
+        return None
+
+    def commit(self) -> None:
+        timestamp: float = now()
+        self.con.executemany(
+            'INSERT OR REPLACE INTO log_checkpoints (name, path, inode, size, offset, updated, fingerprint) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [
+                (self.name, path, inode, stat(path).st_size, offset, timestamp, self.fingerprint(path, inode, offset))
+                for path, (inode, offset) in self.pending.items()
+            ]
+        )
+        self.con.commit()
+        self.saved.update(
+            (path, (inode, offset, self.fingerprint(path, inode, offset)))
+            for path, (inode, offset) in self.pending.items()
+        )
+        self.pending.clear()
+
+    @staticmethod
+    def fingerprint(path: str, inode: int, offset: int) -> bytes:
+        # Only checked against the live file while it has the same inode. A checkpoint left on a rotated copy has none.
+        return fingerprint(path, offset) if stat(path).st_ino == inode else b''
+
+
+def fingerprint(path: str, offset: int, size: int = 64) -> bytes:
+    # The (up to) size bytes of a live, uncompressed log just before offset
+    start: int = max(0, offset - size)
+
+    with open(path, 'rb') as fh:
+        fh.seek(start)
+        return fh.read(offset - start)
+
+
+class LogManifest:
+    """The first and last day found in each rotated log file, stored in the log_manifest table. Files that cannot hold
+    lines from the day being profiled are skipped without being decompressed.
+
+    Rotated files never change, so a file is only scanned once. Rows are keyed by the inode, size and mtime of the
+    file rather than its path, because logrotate renames every archive each time it rotates (auth.log.2.gz becomes
+    auth.log.3.gz). Live files are always read. They still change, and any checkpoints are kept against them."""
+
+    def __init__(self, con: sqlite3.Connection):
+        self.con: sqlite3.Connection = con
+        self.con.execute('''
+            CREATE TABLE IF NOT EXISTS log_manifest (
+            inode INTEGER,
+            size INTEGER,
+            mtime REAL,
+            path TEXT,
+            first_date TEXT,
+            last_date TEXT,
+            PRIMARY KEY (inode, size, mtime)
+            )''')
+        self.con.commit()
+
+    def select(self, files: Iterable[str], day: date, line_date: Callable[[str, int], date | None],
+               last_day: date | None = None) -> list[str]:
+        # The files that may have lines from day (or from day to last_day). line_date(line, year) reads the date of a
+        # line, eg: ssh_line_date
+        last_day = last_day or day
+        selected: list[str] = []
+
+        for file in files:
+            if is_live(file):
+                selected.append(file)
+                continue
+
+            first_date, last_date = self.date_range(file, line_date)
+
+            if first_date is None or last_date is None or (first_date <= last_day and day <= last_date):
+                selected.append(file)
+
+        return selected
+
+    def date_range(self, file: str, line_date: Callable[[str, int], date | None]) -> tuple[date | None, date | None]:
+        file_stat = stat(file)
+        key: tuple[int, int, float] = (file_stat.st_ino, file_stat.st_size, file_stat.st_mtime)
+        row: tuple | None = self.con.execute(
+            'SELECT first_date, last_date FROM log_manifest WHERE inode = ? AND size = ? AND mtime = ?', key
+        ).fetchone()
+
+        if row:
+            return tuple(date.fromisoformat(value) if value else None for value in row)
+
+        first_date, last_date = self.scan(file, line_date, datetime.fromtimestamp(file_stat.st_mtime).date())
+        self.con.execute(
+            'INSERT OR REPLACE INTO log_manifest (inode, size, mtime, path, first_date, last_date) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (*key, file, first_date and first_date.isoformat(), last_date and last_date.isoformat())
+        )
+        self.con.commit()
+        return first_date, last_date
+
+    @staticmethod
+    def scan(file: str, line_date: Callable[[str, int], date | None],
+             modified: date) -> tuple[date | None, date | None]:
+        # Read the whole file once. Only the first and last lines are parsed.
+        first_line: str | None = None
+        last_line: str | None = None
+
+        with open_log(file) as fh:
+            for raw_line in fh:
+                if raw_line.strip():
+                    last_line = raw_line.decode(errors='replace')
+
+                    if first_line is None:
+                        first_line = last_line
+
+        if first_line is None:
+            return None, None
+
+        return dated(first_line, line_date, modified), dated(last_line, line_date, modified)
+
+
+class ParseCache:
+    """What the profilers parsed out of each rotated log, so reruns and backfills do not decompress and parse it again.
+    Stored in the parse_cache table: one marshalled, zlib compressed list of records per file, kind and day. A row with
+    an empty day marks a file as complete.
+
+    Rotated files never change, so like LogManifest the rows are keyed by inode, size and mtime, which survive
+    logrotate renaming the file. Rows of files older than max_age_days are dropped, since logrotate has deleted those.
+
+    records = cache.get(filename, 'ssh', 'Oct 17')
+    if records is None:
+        cache.put(filename, 'ssh', {'Oct 17': [...], 'Oct 18': [...]})"""
+
+    def __init__(self, con: sqlite3.Connection, max_age_days: int = 90):
+        self.con: sqlite3.Connection = con
+        self.con.execute('''
+            CREATE TABLE IF NOT EXISTS parse_cache (
+            inode INTEGER,
+            size INTEGER,
+            mtime REAL,
+            kind TEXT,
+            day TEXT,
+            seq INTEGER,
+            records BLOB,
+            PRIMARY KEY (inode, size, mtime, kind, day)
+            )''')
+        self.con.execute('DELETE FROM parse_cache WHERE mtime < ?', (now() - max_age_days * 86400,))
+        self.con.commit()
+
+    @staticmethod
+    def key(filename: str) -> tuple[int, int, float]:
+        file_stat = stat(filename)
+        return file_stat.st_ino, file_stat.st_size, file_stat.st_mtime
+
+    def get(self, filename: str, kind: str, day: str | None = None) -> list | None:
+        # The records of day (every day when None, in the order of the file), or None when filename is not cached
+        key: tuple[int, int, float] = self.key(filename)
+        query: str = 'SELECT records FROM parse_cache WHERE inode = ? AND size = ? AND mtime = ? AND kind = ?'
+
+        if self.con.execute(f"{query} AND day = ''", (*key, kind)).fetchone() is None:
+            return None
+
+        if day is None:
+            rows: list[tuple] = self.con.execute(f"{query} AND day != '' ORDER BY seq", (*key, kind)).fetchall()
+        else:
+            rows = self.con.execute(f'{query} AND day = ?', (*key, kind, day)).fetchall()
+
+        return [record for row in rows for record in marshal.loads(zlib.decompress(row[0]))]
+
+    def put(self, filename: str, kind: str, records_by_day: dict[str, list]) -> None:
+        # records hold only what marshal can store: str, int, float, and plain tuples and lists of them
+        key: tuple[int, int, float] = self.key(filename)
+        self.con.executemany(
+            'INSERT OR REPLACE INTO parse_cache (inode, size, mtime, kind, day, seq, records) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [
+                (*key, kind, day, seq, zlib.compress(marshal.dumps(records)))
+                for seq, (day, records) in enumerate(records_by_day.items())
+            ] + [(*key, kind, '', -1, b'')]
+        )
+        self.con.commit()
+
+
+class LogScan:
+    """What SshLogScan and VhostDispatcher share: where their lines come from, and the parse cache of rotated logs.
+    Rotated logs never change, so each is parsed once, for every day it holds, and later runs read the records of
+    their day from the cache."""
+
+    def __init__(self, log_date: str | None = None, reader=None, checkpoints=None, hold=None, day: date | None = None,
+                 cache=None):
+        self.log_date: str | None = log_date  # Lines of other days are skipped before they are parsed
+        self.day: date | None = day  # The day of log_date. Plain logs are then only searched where that day is
+        self.reader = reader  # Callable taking a filename and yielding lines. Defaults to log_files.grep_log
+        self.checkpoints = checkpoints  # log_files.LogCheckpoints, to only read what was added since the last run
+        self.hold = hold  # With checkpoints, reading a file stops at the first line hold(line) is true for
+        self.cache = cache  # log_files.ParseCache for rotated logs. None: ip_profile_lib's, False: off
+
+    def parse_cache(self):
+        if self.cache is None:
+            from ip_profile_lib import config, cache_parsed_logs
+            self.cache = cache_parsed_logs and config.parse_cache
+
+        return self.cache
+
+    def reads_locally(self, filename: str) -> bool:
+        # Files read through checkpoints or the parse cache stay out of the process pool
+        if is_live(filename):
+            return bool(self.checkpoints)
+
+        return not (self.checkpoints or self.reader) and bool(self.parse_cache())
+
+    def cached_records(self, filename: str, kind: str, parse: Callable[[str], Iterable[tuple]]) -> list[tuple]:
+        # The records of log_date (every day when None) in the rotated log filename. When it is not cached yet,
+        # parse(filename) reads every day of it, as NamedTuples with a day field or property, and they are all kept.
+        records: list | None = self.cache.get(filename, kind, self.log_date)
+
+        if records is None:
+            by_day: dict[str, list[tuple]] = {}
+
+            for record in parse(filename):
+                by_day.setdefault(record.day, []).append(tuple(record))
+
+            self.cache.put(filename, kind, by_day)
+            records = by_day.get(self.log_date, []) if self.log_date else [
+                record for day_records in by_day.values() for record in day_records
+            ]
+
+        return records
@@ -0,0 +1,265 @@
+#!/nfs_share/matt_desktop/server_scripts/ip_profile/venv_311/bin/python3.11
+import re
+from typing import Iterable, Iterator, NamedTuple
+from datetime import date
+from log_files import LogScan, is_live, map_log_chunks, grep_log, ssh_line_date
+
+# One pass of a single compiled regex classifies the line and pulls out every field at once. Usernames are matched
+# lazily up to the ip and the word 'port', so empty usernames and usernames containing spaces both come out intact.
+ssh_line_pattern: re.Pattern = re.compile(r'''
+    ^(?P<timestamp>[A-Z][a-z]{2}\ [\ \d]\d\ \d{2}:\d{2}:\d{2})  # Jan  1 12:00:00
+    \ \S+\ [^:]+:\                                              # hostname sshd[123]:
+    (?:
+        (?P<failed>
+            Connection\ closed\ by\ (?:invalid|authenticating)\ user
+            |Disconnected\ from\ (?:invalid|authenticating)\ user
+            |Disconnecting\ invalid\ user
+        )
+        |(?P<accepted>Accepted\ (?:publickey|password)\ for)
+    )
+    \ (?P<user>.*?)\ (?:from\ )?(?P<ip>[\da-fA-F.:]+)\ port\ (?P<port>\d+)
+''', re.VERBOSE)
+
+login_needle: str = ' port '  # On every failed and accepted login line. Lines without it are skipped undecoded
+blank_user: str = "' '"  # Stored in place of empty or whitespace usernames. A whitespace inside literal single-quotes
+
+
+class SshEvent(NamedTuple):
+    kind: str       # 'failed' or 'accepted'
+    timestamp: str  # As logged, eg: 'Jan  1 12:00:00'
+    user: str
+    ip: str
+    port: int
+
+    @property
+    def time(self) -> str:
+        return self.timestamp[-8:]  # HH:MM:SS
+
+    @property
+    def day(self) -> str:
+        return self.timestamp[:6]  # Same format as ssh_log_date ('%b %e')
+
+
+def parse_ssh_line(line: str) -> SshEvent | None:
+    # Returns None for lines that are not a failed or accepted login
+    match: re.Match | None = ssh_line_pattern.match(line)
+
+    if match is None:
+        return None
+
+    user: str = match['user']
+
+    if not user.strip():
+        user = blank_user
+
+    return SshEvent(
+        kind='failed' if match['failed'] else 'accepted',
+        timestamp=match['timestamp'],
+        user=user,
+        ip=match['ip'],
+        port=int(match['port'])
+    )
+
+
+def parse_ssh_lines(lines: Iterable[str], log_date: str | None = None) -> Iterator[SshEvent]:
+    # Yields an SshEvent for each login in lines. With log_date ('%b %e'), lines from other days are skipped before
+    # the regex runs, which is most of them.
+    for line in lines:
+        if log_date and not line.startswith(log_date):
+            continue
+
+        event: SshEvent | None = parse_ssh_line(line)
+
+        if event is not None:
+            yield event
+
+
+class SshLogScan(LogScan):
+    """Reads each ssh log once and hands every event to the consumers registered for its kind ('failed' or
+    'accepted'). Several profilers can share one scan, so the same logs are not read and decompressed twice.
+
+    scan = SshLogScan(ssh_log_files, ssh_log_date)
+    scan.register('failed', failed_logins)
+    scan.register('accepted', accepted_logins)
+    scan.run()
+
+    events() yields the events without dispatching them, for use as the source of an ip_profile_lib.Pipeline."""
+
+    def __init__(self, files: Iterable[str], log_date: str | None = None, reader=None, checkpoints=None, hold=None,
+                 day: date | None = None, cache=None):
+        super().__init__(log_date, reader, checkpoints, hold, day, cache)
+        self.files: list[str] = list(files)
+        self.consumers: dict[str, list] = {'failed': [], 'accepted': []}
+
+    def register(self, kind: str, consumer) -> None:
+        # consumer is any callable taking an SshEvent
+        if kind not in self.consumers:
+            raise ValueError(f'Unknown ssh event kind: {kind}')
+
+        self.consumers[kind].append(consumer)
+
+    def run(self, workers: int | None = None) -> int:
+        # Returns the number of events dispatched
+        dispatched: int = 0
+
+        for event in self.events(workers):
+            dispatched += self.dispatch(event)
+
+        return dispatched
+
+    def dispatch(self, event: SshEvent) -> int:
+        # Hands event to the consumers registered for its kind. Returns how many there were.
+        consumers: list = self.consumers[event.kind]
+
+        for consumer in consumers:
+            consumer(event)
+
+        return len(consumers)
+
+    def events(self, workers: int | None = None) -> Iterator[SshEvent]:
+        """Every event of log_date in the logs. With more than one worker (default: ip_profile_lib.parse_workers),
+        files are parsed by a pool of processes, which send back only the events of log_date. The events come in the
+        same order either way. The reader is only used for files read in this process."""
+        from ip_profile_lib import parse_workers, parse_chunk_size
+
+        workers = workers or parse_workers
+        files: list[str] = self.checkpoints.select(self.files) if self.checkpoints else self.files
+
+        if workers > 1:
+            events: Iterable[SshEvent] = map_log_chunks(
+                files, parse_ssh_chunk, (self.log_date, self.day), workers, parse_chunk_size,
+                local_files=[file for file in files if self.reads_locally(file)],
+                read_local=self.events_of
+            )
+        else:
+            events = (event for filename in files for event in self.events_of(filename))
+
+        yield from events
+
+    def events_of(self, filename: str) -> Iterator[SshEvent]:
+        if self.checkpoints:
+            from ip_profile_lib import log_reader
+            lines: Iterable[str] = (self.reader or log_reader)(filename, self.checkpoints, self.hold)
+        elif self.reader:
+            lines = self.reader(filename)
+        elif self.parse_cache() and not is_live(filename):
+            return self.cached_events(filename)
+        else:
+            lines = grep_log(filename, (self.log_date, login_needle), day=self.day, line_date=ssh_line_date)
+
+        return parse_ssh_lines(lines, self.log_date)
+
+    def cached_events(self, filename: str) -> Iterator[SshEvent]:
+        records: list[tuple] = self.cached_records(
+            filename, 'ssh', lambda filename: parse_ssh_lines(grep_log(filename, (login_needle,)))
+        )
+        return map(SshEvent._make, records)
+
+
+def parse_ssh_chunk(filename: str, start: int, end: int | None, log_date: str | None,
+                    day: date | None = None) -> list[SshEvent]:
+    # Runs in a worker process of SshLogScan.run()
+    lines: Iterator[str] = grep_log(filename, (log_date, login_needle), start, end, day, ssh_line_date)
+    return list(parse_ssh_lines(lines, log_date))
+
+
+def legacy_parse_ssh_lines(lines: Iterable[str], log_date: str) -> Iterator[tuple[str, str, str]]:
+    # The substring and split() parser ip_profile_ssh.py used before ssh_log_parser. Kept for the benchmark below.
+    for line in lines:
+        if 'Connection closed by invalid user' in line and log_date in line:
+            line_elements: tuple[int, int, int] | None = (2, 10, 11)
+        elif 'Connection closed by authenticating user' in line and log_date in line:
+            line_elements = (2, 10, 11)
+        elif 'Disconnected from invalid user' in line and log_date in line:
+            line_elements = (2, 9, 10)
+        elif 'Disconnected from authenticating user' in line and log_date in line:
+            line_elements = (2, 9, 10)
+        elif 'Disconnecting invalid user' in line and log_date in line:
+            line_elements = (2, 8, 9)
+        else:
+            line_elements = None
+
+        if line_elements:
+            x, y, z = line_elements
+            time: str = line.split()[x]
+            user: str = line.split()[y]
+            ip: str = line.split()[z]
+
+            if '  ' in line[7:]:
+                user = blank_user
+                ip = line.split()[z - 1]
+
+            yield time, user, ip
+
+
+def write_sample_log(path: str, num_lines: int, log_date: str = 'Jan  2') -> None:
+    # A synthetic auth.log for the benchmark. About one line in ten is a login on log_date, the rest is noise.
+    from random import choice, randrange
+
+    templates: list[str] = [
+        '{d} {t} host sshd[{p}]: Connection closed by invalid user {u} {ip} port {port} [preauth]',
+        '{d} {t} host sshd[{p}]: Disconnected from authenticating user {u} {ip} port {port} [preauth]',
+        '{d} {t} host sshd[{p}]: Disconnecting invalid user {u} {ip} port {port}: Too many authentication failures',
+        '{d} {t} host sshd[{p}]: Accepted publickey for {u} from {ip} port {port} ssh2: ED25519 SHA256:abc',
+    ]
+    noise: list[str] = [
+        '{d} {t} host CRON[{p}]: pam_unix(cron:session): session opened for user root(uid=0) by (uid=0)',
+        '{d} {t} host sshd[{p}]: Received disconnect from {ip} port {port}:11: Bye Bye [preauth]',
+        '{d} {t} host systemd-logind[{p}]: New session 42 of user matt.',
+    ]
+    users: list[str] = ['root', 'admin', 'ubuntu', 'test', '', 'oracle']
+
+    with open(path, 'w') as fh:
+        for _ in range(num_lines):
+            is_login: bool = randrange(10) == 0
+            fh.write((choice(templates) if is_login else choice(noise)).format(
+                d=log_date if is_login else 'Jan  1',
+                t=f'{randrange(24):02}:{randrange(60):02}:{randrange(60):02}',
+                p=randrange(1, 99999),
+                u=choice(users),
+                ip=f'{randrange(1, 224)}.{randrange(256)}.{randrange(256)}.{randrange(256)}',
+                port=randrange(1024, 65535)
+            ) + '\n')
+
+
+def benchmark(path: str | None = None, num_lines: int = 2_000_000, log_date: str = 'Jan  2') -> None:
+    # Compare the throughput of parse_ssh_lines() with the old parser on a real or synthetic auth.log
+    from time import perf_counter
+    from tempfile import NamedTemporaryFile
+    from os import remove
+
+    generated: bool = path is None
+
+    if generated:
+        with NamedTemporaryFile('w', suffix='.log', delete=False) as fh:
+            path = fh.name
+        write_sample_log(path, num_lines, log_date)
+
+    try:
+        with open(path, 'r') as fh:
+            lines: list[str] = fh.readlines()  # Read up front so only parsing is timed
+
+        parsers: tuple = (
+            ('legacy', lambda: legacy_parse_ssh_lines(lines, log_date)),
+            ('regex', lambda: (event for event in parse_ssh_lines(lines, log_date) if event.kind == 'failed')),
+        )
+
+        for name, parser in parsers:  # Both count failed logins only, since the old parser ignored the rest
+            start: float = perf_counter()
+            found: int = sum(1 for _ in parser())
+            elapsed: float = perf_counter() - start
+            print(f'{name:>7}: {len(lines) / elapsed:>12,.0f} lines/s  {elapsed:6.2f}s  {found:,} logins')
+    finally:
+        if generated:
+            remove(path)
+
+
+if __name__ == '__main__':
+    # Usage: ssh_log_parser.py [auth.log] [log_date]
+    # Without a file, a synthetic log of two million lines is generated. log_date defaults to 'Jan  2'.
+    from sys import argv
+
+    benchmark(
+        path=argv[1] if len(argv) > 1 else None,
+        log_date=argv[2] if len(argv) > 2 else 'Jan  2'
+    )